@@ -0,0 +1,73 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import shop
+
+# Bounded pool for blocking pymongo calls so the bot event loop never waits on Mongo
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 8))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function in the Mongo executor and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _async(func):
+    """Wrap a blocking database function so it can be awaited from handlers"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+def shutdown_executor(wait=True):
+    """Stop the Mongo executor (called when the bot loop shuts down)"""
+    _executor.shutdown(wait=wait)
+
+# --- User & balance functions (utils.py) ---
+ensure_user = _async(utils.ensure_user)
+create_user = _async(utils.create_user)
+get_user = _async(utils.get_user)
+update_user_balance = _async(utils.update_user_balance)
+roll_dice = _async(utils.roll_dice)
+claim_daily_reward = _async(utils.claim_daily_reward)
+transfer_wishes = _async(utils.transfer_wishes)
+record_transaction = _async(utils.record_transaction)
+get_user_transactions = _async(utils.get_user_transactions)
+get_user_transactions_page = _async(utils.get_user_transactions_page)
+get_user_monthly_summaries = _async(utils.get_user_monthly_summaries)
+add_wishes_for_stars = _async(utils.add_wishes_for_stars)
+initialize_master_cards = _async(utils.initialize_master_cards)
+backfill_username_lower = _async(utils.backfill_username_lower)
+card_migration_pending = _async(utils.card_migration_pending)
+
+# --- Card ownership (utils.py) ---
+add_card_to_user = _async(utils.add_card_to_user)
+remove_card_from_user = _async(utils.remove_card_from_user)
+user_owns_card = _async(utils.user_owns_card)
+transfer_card = _async(utils.transfer_card)
+get_user_cards = _async(utils.get_user_cards)
+get_user_card_summary = _async(utils.get_user_card_summary)
+get_user_card_count = _async(utils.get_user_card_count)
+
+# --- Shop & P2P marketplace (shop.py versions are the ones the bot uses) ---
+get_daily_shop_items = _async(shop.get_daily_shop_items)
+pregenerate_personal_shops = _async(shop.pregenerate_personal_shops)
+prepare_daily_shop = _async(shop.prepare_daily_shop)
+buy_from_default_shop = _async(shop.buy_from_default_shop)
+refresh_daily_shop = _async(shop.refresh_daily_shop)
+create_p2p_listing = _async(shop.create_p2p_listing)
+buy_from_p2p = _async(shop.buy_from_p2p)
+get_p2p_listings_page = _async(shop.get_p2p_listings_page)
+count_active_listings = _async(shop.count_active_listings)
+
+# --- Lookups used directly by handlers ---
+async def resolve_username(username):
+    """Get the user_id for a @username, only touching Mongo on a cache miss"""
+    user_id = utils.username_map.cached_id(username)
+    if user_id is None:
+        user_id = await run_db(utils.username_map.resolve, username)
+    return user_id
@@ -0,0 +1,55 @@
+import threading
+
+class CardCatalog:
+    """In-memory copy of the master_cards collection, indexed by card_id and rarity.
+
+    The catalog is small and effectively static, so it is loaded once and served
+    from memory. Lookups never query Mongo - until load() has found cards they see
+    an empty catalog - so they are safe to call on the event loop. Call load()
+    (from the Mongo executor) again whenever master_cards changes; an empty load
+    keeps the current cards. Returned card documents are shared - copy them
+    before modifying.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_rarity = {}
+
+    def load(self):
+        """(Re)load every card from Mongo and rebuild the indexes, returns the card count"""
+        # Sorted so seeded draws pick the same cards in every process and after reloads
+        cards = list(self._collection.find().sort("card_id", 1)) if self._collection is not None else []
+        by_id = {}
+        by_rarity = {}
+        for card in cards:
+            by_id[card["card_id"]] = card
+            by_rarity.setdefault(card["rarity"], []).append(card)
+        if not cards:
+            return len(self._by_id)  # Not seeded yet - keep what we have
+        with self._lock:
+            self._by_id = by_id
+            self._by_rarity = by_rarity
+        return len(by_id)
+
+    def _indexes(self):
+        with self._lock:
+            return self._by_id, self._by_rarity
+
+    def get(self, card_id):
+        """Get a card by card_id (None if unknown)"""
+        return self._indexes()[0].get(card_id)
+
+    def by_rarity(self, rarity):
+        """Get all cards of a rarity"""
+        return self._indexes()[1].get(rarity, [])
+
+    def all(self):
+        """Get every card in the catalog"""
+        return list(self._indexes()[0].values())
+
+    def rarities(self):
+        """Get the rarities that have at least one card"""
+        return list(self._indexes()[1].keys())
+
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Index bootstrap for the bot's MongoDB collections.
+
+ensure_indexes() is idempotent and runs from initialize_bot on every start.
+Run this file with --verify to explain() every query shape the bot issues
+and fail on any collection scan.
+"""
+import sys
+import logging
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Collection name -> indexes backing the access patterns in utils.py / shop.py
+INDEXES = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("username_lower", ASCENDING)]),
+    ],
+    "transactions": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+    "transactions_archive": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ],
+    "transaction_summaries": [
+        IndexModel([("user_id", ASCENDING), ("month", DESCENDING)], unique=True),
+    ],
+    "owned_cards": [
+        IndexModel([("user_id", ASCENDING), ("card_id", ASCENDING)], unique=True),
+    ],
+    "p2p_listings": [
+        IndexModel([("is_active", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("seller_id", ASCENDING), ("is_active", ASCENDING), ("card_id", ASCENDING)]),
+    ],
+    "master_cards": [
+        IndexModel([("card_id", ASCENDING)], unique=True),
+        IndexModel([("rarity", ASCENDING)]),
+    ],
+    "daily_shop": [
+        IndexModel([("date", ASCENDING)], unique=True),
+    ],
+    "personal_shops": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+# Indexes superseded by the ones above - dropped so they stop costing writes and storage
+LEGACY_INDEXES = {
+    "transactions": ["user_id_1_timestamp_-1"],  # replaced by (user_id, timestamp, _id)
+    "users": ["username_1"],                     # lookups use username_lower
+}
+
+def _find_duplicates(collection, field):
+    """Return values of `field` that appear in more than one document"""
+    pipeline = [
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 20},
+    ]
+    return [doc["_id"] for doc in collection.aggregate(pipeline)]
+
+def _create_index(collection, model):
+    """Create one index, falling back to a non-unique index if existing data has duplicates"""
+    try:
+        collection.create_indexes([model])
+    except (DuplicateKeyError, OperationFailure) as e:
+        spec = model.document
+        if not spec.get("unique"):
+            raise
+        field = next(iter(spec["key"]))
+        duplicates = _find_duplicates(collection, field)
+        logger.error(
+            f"Cannot build unique index on {collection.name}.{field}: duplicate values {duplicates} ({e}). "
+            f"Creating a non-unique index until the duplicates are cleaned up."
+        )
+        collection.create_index(list(spec["key"].items()))
+
+def ensure_indexes():
+    """Create every declared index and drop legacy ones (safe to call on every startup)"""
+    if utils.db is None:
+        print("Database not connected - skipping index bootstrap")
+        return False
+
+    for collection_name, models in INDEXES.items():
+        collection = utils.db[collection_name]
+        for model in models:
+            _create_index(collection, model)
+    for collection_name, names in LEGACY_INDEXES.items():
+        collection = utils.db[collection_name]
+        existing = collection.index_information()
+        for name in names:
+            if name in existing:
+                collection.drop_index(name)
+                logger.info(f"Dropped legacy index {collection_name}.{name}")
+    logger.info("MongoDB indexes verified")
+    return True
+
+def _keyset(query, field, forward):
+    """A keyset page query as issued by get_p2p_listings_page / get_user_transactions_page"""
+    return {**query, **utils.keyset_filter(field, datetime(1970, 1, 1), ObjectId(), forward)}
+
+# Query shapes issued by utils.py and shop.py, as (collection, filter, sort)
+QUERY_SHAPES = [
+    ("users", {"user_id": 0}, None),
+    ("users", {"username_lower": ""}, None),
+    ("transactions", {"user_id": 0}, [("timestamp", DESCENDING)]),
+    ("transactions", {"user_id": 0}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("transactions", {"timestamp": {"$lt": 0}}, [("timestamp", ASCENDING)]),
+    ("transactions", _keyset({"user_id": 0}, "timestamp", False), [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("transactions", _keyset({"user_id": 0}, "timestamp", True), [("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    ("transactions_archive", {"user_id": 0}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("transactions_archive", _keyset({"user_id": 0}, "timestamp", False), [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("transactions_archive", _keyset({"user_id": 0}, "timestamp", True), [("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    ("transaction_summaries", {"user_id": 0}, [("month", DESCENDING)]),
+    ("owned_cards", {"user_id": 0, "count": {"$gte": 1}}, [("card_id", ASCENDING)]),
+    ("owned_cards", {"user_id": 0, "card_id": ""}, None),
+    ("p2p_listings", {"is_active": True}, [("created_at", ASCENDING), ("_id", ASCENDING)]),
+    ("p2p_listings", _keyset({"is_active": True}, "created_at", True), [("created_at", ASCENDING), ("_id", ASCENDING)]),
+    ("p2p_listings", _keyset({"is_active": True}, "created_at", False), [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("p2p_listings", {"seller_id": 0, "is_active": True}, None),
+    ("p2p_listings", {"seller_id": 0, "card_id": "", "is_active": True}, None),
+    ("master_cards", {"card_id": ""}, None),
+    ("master_cards", {"rarity": ""}, None),
+    ("daily_shop", {"date": ""}, None),
+]
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree"""
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+def verify_query_plans():
+    """explain() every known query shape and raise if any of them scans a whole collection"""
+    if utils.db is None:
+        print("Database not connected - cannot verify query plans")
+        return False
+
+    collscans = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = utils.db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            collscans.append(f"{collection_name}.find({query})")
+
+    if collscans:
+        raise RuntimeError("Collection scans detected for: " + ", ".join(collscans))
+    logger.info(f"All {len(QUERY_SHAPES)} query shapes use an index")
+    return True
+
+def main():
+    ensure_indexes()
+    if "--verify" in sys.argv:
+        verify_query_plans()
+        print("✅ Every query shape is served by an index")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import time
+import threading
+from pymongo.errors import BulkWriteError
+
+class LedgerWriter:
+    """Append-only transaction ledger that buffers documents and writes them with insert_many.
+
+    Buffered entries are flushed when batch_size is reached or flush_interval
+    seconds have passed, on the periodic flush task and on shutdown. Flows that
+    must be durable immediately use write_now(), optionally inside a session.
+    """
+
+    def __init__(self, collection, batch_size=100, flush_interval=5):
+        self._collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.flushed = 0
+        self.flushes = 0
+
+    def append(self, *docs):
+        """Buffer ledger entries, flushing if the batch is full or the interval has passed"""
+        with self._lock:
+            self._buffer.extend(docs)
+            should_flush = (
+                len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write every buffered entry with one unordered insert_many"""
+        if self._collection is None:
+            return 0
+        with self._lock:
+            docs, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        if not docs:
+            return 0
+
+        try:
+            self._collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate _ids are entries a previous, partly failed flush already wrote
+            failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+            self._requeue([doc for i, doc in enumerate(docs) if i in failed])
+            print(f"Ledger flush had {len(failed)} failed entries, retrying them on the next flush")
+            return len(docs) - len(failed)
+        except Exception as e:
+            # insert_many assigned _ids already, so a retry can't duplicate entries
+            self._requeue(docs)
+            print(f"Error flushing ledger: {e}")
+            return 0
+
+        with self._lock:
+            self.flushed += len(docs)
+            self.flushes += 1
+        return len(docs)
+
+    def _requeue(self, docs):
+        with self._lock:
+            self._buffer[:0] = docs
+
+    def write_now(self, docs, session=None):
+        """Write entries immediately (in the caller's transaction when a session is given)"""
+        if self._collection is None or not docs:
+            return
+        self._collection.insert_many(docs, ordered=False, session=session)
+
+    def pending_for(self, user_id):
+        """Get buffered entries for a user that aren't in Mongo yet"""
+        with self._lock:
+            return [doc for doc in self._buffer if doc["user_id"] == user_id]
+
+    def stats(self):
+        """Get buffer and flush counters for /stats"""
+        with self._lock:
+            return {'pending': len(self._buffer), 'flushed': self.flushed, 'flushes': self.flushes}
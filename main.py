@@ -1,14 +1,22 @@
 import os
+import socket
 import logging
 from datetime import datetime
-from flask import Flask, request, Response
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler
 from dotenv import load_dotenv
 from utils import *
 from shop import *
+from indexes import ensure_indexes, verify_query_plans
+import async_db
+import scheduler
 import asyncio
-import threading
+import uvicorn
 
 # Load environment variables
 load_dotenv()
@@ -41,16 +49,35 @@ if BOT_TOKEN == '<YOUR_BOT_TOKEN>':
 # Wish symbol
 WISH_SYMBOL = "𝓒"
 
-# Create Flask app
-app = Flask(__name__)
-
 # Create telegram application
 application = Application.builder().token(BOT_TOKEN).updater(None).build()
 
-# Global event loop for async operations
-bot_loop = None
-bot_thread = None
-bot_ready = threading.Event()  # Readiness flag for synchronization
+# Bot state - set once the bot is started on the server's event loop
+bot_running = False
+background_tasks = set()  # Update workers and periodic jobs
+
+# Webhook update queue - the webhook only enqueues, workers process
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 4))
+# One queue per worker; updates are routed by user_id so each user's updates run in order
+update_queues = []  # asyncio.Queues, created when the bot starts
+
+# Identifies this process in Mongo leases when running several workers/instances
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+STARTUP_LEASE_TTL = 60  # seconds - one worker per deploy registers the webhook and commands
+CATALOG_WAIT_SECONDS = 30  # how long a non-leader waits for the leader to seed master_cards
+CATALOG_RETRY_INTERVAL = 5  # seconds between catalog loads when startup found no cards
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 25))  # seconds to finish queued updates
+queue_stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+
+async def track_usernames(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record the sender's (and a replied-to user's) current username - memory only, flushed in batches"""
+    if update.effective_user:
+        username_map.observe(update.effective_user.id, update.effective_user.username)
+    message = update.effective_message
+    if message and message.reply_to_message and message.reply_to_message.from_user:
+        replied = message.reply_to_message.from_user
+        username_map.observe(replied.id, replied.username)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -58,7 +85,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     
     # Create user if doesn't exist
-    create_user(user_id, username)
+    await async_db.ensure_user(user_id, username)
     
     welcome_text = f"""
 ✨ Welcome to the VexaSwitch Store ✨
@@ -100,11 +127,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def vault(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /vault command (same as balance)"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
-    
-    if not user:
-        create_user(user_id, update.effective_user.username)
-        user = get_user(user_id)
+    user = await async_db.ensure_user(user_id, update.effective_user.username)
     
     balance_text = f"💰 Your balance: {user['wish_balance']} {WISH_SYMBOL}"
     await update.message.reply_text(balance_text)
@@ -113,45 +136,34 @@ async def dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /dice command - earn extra wishes randomly (4 times per day)"""
     user_id = update.effective_user.id
     
-    if not get_user(user_id):
-        create_user(user_id, update.effective_user.username)
-    
-    # Check if user can use dice (4 times per day)
-    if not can_use_dice(user_id):
-        await update.message.reply_text("⏰ You've reached your daily dice limit (4 times)! Try again tomorrow.")
-        return
-    
-    # Use one dice attempt
-    use_dice(user_id)
+    await async_db.ensure_user(user_id, update.effective_user.username)
     
     # Random reward between 1-10 wishes
     import random
     reward_amount = random.randint(1, 10)
-    update_user_balance(user_id, reward_amount)
-    record_transaction(user_id, "dice_reward", reward_amount, "Random dice reward")
     
-    # Get updated user data and dice uses
-    user = get_user(user_id)
+    # Count the roll and credit the reward in one atomic update (4 times per day)
+    user = await async_db.roll_dice(user_id, reward_amount)
+    if not user:
+        await update.message.reply_text("⏰ You've reached your daily dice limit (4 times)! Try again tomorrow.")
+        return
+    
     dice_uses = user.get("dice_uses_today", 0)
-    remaining_uses = 4 - dice_uses
+    remaining_uses = DICE_DAILY_LIMIT - dice_uses
     
     success_text = f"""
 🎲 Lucky dice roll!
 +{reward_amount} {WISH_SYMBOL}
 
 💰 New balance: {user['wish_balance']} {WISH_SYMBOL}
-🎯 Dice uses left today: {remaining_uses}/4
+🎯 Dice uses left today: {remaining_uses}/{DICE_DAILY_LIMIT}
     """
     await update.message.reply_text(success_text)
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /balance command"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
-    
-    if not user:
-        create_user(user_id, update.effective_user.username)
-        user = get_user(user_id)
+    user = await async_db.ensure_user(user_id, update.effective_user.username)
     
     balance_text = f"💰 Your balance: {user['wish_balance']} {WISH_SYMBOL}"
     await update.message.reply_text(balance_text)
@@ -160,14 +172,11 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /daily command"""
     user_id = update.effective_user.id
     
-    if not get_user(user_id):
-        create_user(user_id, update.effective_user.username)
+    await async_db.ensure_user(user_id, update.effective_user.username)
     
-    if can_claim_daily(user_id):
-        reward_amount = 10
-        claim_daily_reward(user_id, reward_amount)
-        
-        user = get_user(user_id)
+    reward_amount = 10
+    user = await async_db.claim_daily_reward(user_id, reward_amount)
+    if user:
         success_text = f"""
 🎁 Daily reward claimed!
 +{reward_amount} {WISH_SYMBOL}
@@ -200,11 +209,10 @@ async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username = target_input[1:]  # Remove @
             # Find user by username
             if users is not None:
-                target_user = users.find_one({"username": username})
-                if not target_user:
+                to_user_id = await async_db.resolve_username(username)
+                if to_user_id is None:
                     await update.message.reply_text(f"❌ User @{username} not found. They need to start the bot first.")
                     return
-                to_user_id = target_user["user_id"]
             else:
                 await update.message.reply_text("❌ Demo mode: Username lookup not available. Use user ID instead.")
                 return
@@ -220,8 +228,8 @@ async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("You can't transfer to yourself!")
             return
         
-        if transfer_wishes(from_user_id, to_user_id, amount):
-            from_user = get_user(from_user_id)
+        if await async_db.transfer_wishes(from_user_id, to_user_id, amount):
+            from_user = await async_db.get_user(from_user_id)
             success_text = f"""
 ✅ Transfer successful!
 Sent {amount} {WISH_SYMBOL} to user {to_user_id}
@@ -254,8 +262,8 @@ async def transfer_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("You can't transfer to yourself!")
             return
         
-        if transfer_wishes(from_user_id, to_user_id, amount):
-            from_user = get_user(from_user_id)
+        if await async_db.transfer_wishes(from_user_id, to_user_id, amount):
+            from_user = await async_db.get_user(from_user_id)
             success_text = f"""
 ✅ Transfer successful!
 Sent {amount} {WISH_SYMBOL} to user {to_user_id}
@@ -270,6 +278,7 @@ Sent {amount} {WISH_SYMBOL} to user {to_user_id}
 
 async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /buy command - Telegram Stars integration"""
+    await async_db.ensure_user(update.effective_user.id, update.effective_user.username)
     keyboard = [
         [InlineKeyboardButton("500 𝓒 for 30 ⭐", callback_data="buy_wishes_30")],
         [InlineKeyboardButton("1000 𝓒 for 50 ⭐", callback_data="buy_wishes_50")],
@@ -305,56 +314,106 @@ async def mysales_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /mysales command - Coming Soon"""
     await update.message.reply_text("🚧 Coming Soon")
 
-async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /history command"""
-    user_id = update.effective_user.id
-    transactions = get_user_transactions(user_id, limit=10)
-    
-    if not transactions:
-        await update.message.reply_text("📊 No transaction history yet.")
-        return
-    
+HISTORY_PAGE_SIZE = 10
+HISTORY_SUMMARY_MONTHS = 6  # monthly rollups shown under the oldest history page
+
+def build_history_page(entries, has_newer, has_older, summaries=None):
+    """Render one page of transaction history with Newer/Older keyset buttons"""
     history_text = "📊 **Your Transaction History:**\n\n"
     
-    for tx in transactions:
+    for tx in entries:
         timestamp = tx['timestamp'].strftime("%m/%d %H:%M")
         amount_str = f"+{tx['amount']}" if tx['amount'] > 0 else str(tx['amount'])
         history_text += f"• {timestamp}: {amount_str} {WISH_SYMBOL} - {tx['description']}\n"
     
-    await update.message.reply_text(history_text)
+    # The oldest page ends with the monthly rollups of archived history
+    if summaries:
+        history_text += "\n📅 **Monthly Totals (archived):**\n"
+        for summary in summaries:
+            net_str = f"+{summary['net']}" if summary['net'] > 0 else str(summary['net'])
+            history_text += (f"• {summary['month']}: +{summary['credited']} / -{summary['debited']} {WISH_SYMBOL} "
+                             f"(net {net_str}, {summary['count']} entries)\n")
+    
+    navigation = []
+    if has_newer and '_id' in entries[0]:
+        navigation.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"history_newer_{encode_transaction_cursor(entries[0])}"))
+    if has_older and '_id' in entries[-1]:
+        navigation.append(InlineKeyboardButton("Older ➡️", callback_data=f"history_older_{encode_transaction_cursor(entries[-1])}"))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+    return history_text, reply_markup
 
-async def cards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /cards command - show user's card collection"""
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /history command"""
     user_id = update.effective_user.id
-    user_cards_list = get_user_cards(user_id)
+    entries, has_newer, has_older = await async_db.get_user_transactions_page(user_id, page_size=HISTORY_PAGE_SIZE)
     
-    if not user_cards_list:
-        await update.message.reply_text("🃏 You don't have any cards yet! Visit the /shop to buy some.")
+    if not entries:
+        await update.message.reply_text("📊 No transaction history yet.")
         return
     
-    # Group cards by card_id and count duplicates
-    card_counts = {}
-    for card in user_cards_list:
-        card_id = card['card_id']
-        if card_id in card_counts:
-            card_counts[card_id]['count'] += 1
-        else:
-            card_counts[card_id] = {
-                'count': 1,
-                'name': card.get('card_name', card_id),
-                'rarity': card.get('rarity', 'Unknown')
-            }
+    summaries = None if has_older else await async_db.get_user_monthly_summaries(user_id, limit=HISTORY_SUMMARY_MONTHS)
+    history_text, reply_markup = build_history_page(entries, has_newer, has_older, summaries)
+    await update.message.reply_text(history_text, reply_markup=reply_markup)
+
+async def show_history_page(query, older=None, newer=None):
+    """Show an older or newer page of the user's transaction history"""
+    entries, has_newer, has_older = await async_db.get_user_transactions_page(
+        query.from_user.id, older=older, newer=newer, page_size=HISTORY_PAGE_SIZE
+    )
+    if not entries:
+        await query.edit_message_text("📊 No more history! Use /history to start from the latest entries.")
+        return
+    summaries = None if has_older else await async_db.get_user_monthly_summaries(query.from_user.id, limit=HISTORY_SUMMARY_MONTHS)
+    history_text, reply_markup = build_history_page(entries, has_newer, has_older, summaries)
+    await query.edit_message_text(history_text, reply_markup=reply_markup)
+
+CARDS_PAGE_SIZE = 20  # Keeps each /cards page well under Telegram's 4096 character limit
+
+def build_cards_page(card_summary, page):
+    """Render one page of a user's grouped card collection"""
+    total_pages = max(1, (len(card_summary) + CARDS_PAGE_SIZE - 1) // CARDS_PAGE_SIZE)
+    page = min(max(page, 0), total_pages - 1)
     
     cards_text = f"🃏 **Your Card Collection** 🃏\n\n"
-    for card_id, info in card_counts.items():
+    for info in card_summary[page * CARDS_PAGE_SIZE:(page + 1) * CARDS_PAGE_SIZE]:
         count_display = f" x{info['count']}" if info['count'] > 1 else ""
         cards_text += f"• **{info['name']}** ({info['rarity']}){count_display}\n"
-        cards_text += f"  🆔 {card_id}\n\n"
+        cards_text += f"  🆔 {info['card_id']}\n\n"
     
-    cards_text += f"📊 Total unique cards: {len(card_counts)}\n"
-    cards_text += f"📊 Total cards: {len(user_cards_list)}"
+    cards_text += f"📊 Total unique cards: {len(card_summary)}\n"
+    cards_text += f"📊 Total cards: {sum(info['count'] for info in card_summary)}"
     
-    await update.message.reply_text(cards_text)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"cards_page_{page - 1}"))
+    if page < total_pages - 1:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"cards_page_{page + 1}"))
+    if total_pages > 1:
+        cards_text += f"\n📄 Page {page + 1}/{total_pages}"
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+    return cards_text, reply_markup
+
+async def cards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /cards command - show user's card collection"""
+    user_id = update.effective_user.id
+    # Cards are grouped and counted in Mongo - one row per unique card
+    card_summary = await async_db.get_user_card_summary(user_id)
+    
+    if not card_summary:
+        await update.message.reply_text("🃏 You don't have any cards yet! Visit the /shop to buy some.")
+        return
+    
+    cards_text, reply_markup = build_cards_page(card_summary, 0)
+    await update.message.reply_text(cards_text, reply_markup=reply_markup)
+
+async def show_cards_page(query, page):
+    """Show another page of the user's card collection"""
+    card_summary = await async_db.get_user_card_summary(query.from_user.id)
+    if not card_summary:
+        await query.edit_message_text("🃏 You don't have any cards yet! Visit the /shop to buy some.")
+        return
+    cards_text, reply_markup = build_cards_page(card_summary, page)
+    await query.edit_message_text(cards_text, reply_markup=reply_markup)
 
 async def terms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /terms command"""
@@ -442,14 +501,15 @@ async def grant_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             amount = int(context.args[0])
             
             # Ensure target user exists
-            if not get_user(target_user_id):
-                create_user(target_user_id, target_username)
+            await async_db.ensure_user(target_user_id, target_username)
             
             # Grant wishes
-            update_user_balance(target_user_id, amount)
-            record_transaction(target_user_id, "admin_grant", amount, f"Admin grant from owner")
+            target_user = await async_db.update_user_balance(target_user_id, amount)
+            if not target_user:
+                await update.message.reply_text(f"❌ Grant failed - a balance cannot go below 0 {WISH_SYMBOL}")
+                return
+            await async_db.record_transaction(target_user_id, "admin_grant", amount, f"Admin grant from owner")
             
-            target_user = get_user(target_user_id)
             success_text = f"""
 ✅ **Grant Successful**
 Granted {amount} {WISH_SYMBOL} to @{target_username} (ID: {target_user_id})
@@ -470,14 +530,15 @@ Their new balance: {target_user['wish_balance']} {WISH_SYMBOL}
             amount = int(context.args[1])
             
             # Ensure target user exists
-            if not get_user(target_user_id):
-                create_user(target_user_id)
+            await async_db.ensure_user(target_user_id)
             
             # Grant wishes
-            update_user_balance(target_user_id, amount)
-            record_transaction(target_user_id, "admin_grant", amount, f"Admin grant from owner")
+            target_user = await async_db.update_user_balance(target_user_id, amount)
+            if not target_user:
+                await update.message.reply_text(f"❌ Grant failed - a balance cannot go below 0 {WISH_SYMBOL}")
+                return
+            await async_db.record_transaction(target_user_id, "admin_grant", amount, f"Admin grant from owner")
             
-            target_user = get_user(target_user_id)
             success_text = f"""
 ✅ **Grant Successful**
 Granted {amount} {WISH_SYMBOL} to user {target_user_id}
@@ -513,20 +574,16 @@ async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             # Ensure target user exists
-            if not get_user(target_user_id):
-                create_user(target_user_id, target_username)
+            await async_db.ensure_user(target_user_id, target_username)
             
-            # Check if user has enough balance
-            target_user = get_user(target_user_id)
-            if target_user['wish_balance'] < amount:
+            # Remove wishes (negative amount) - fails if user doesn't have enough balance
+            updated_user = await async_db.update_user_balance(target_user_id, -amount)
+            if not updated_user:
+                target_user = await async_db.get_user(target_user_id)
                 await update.message.reply_text(f"❌ User only has {target_user['wish_balance']} {WISH_SYMBOL}, cannot remove {amount} {WISH_SYMBOL}")
                 return
+            await async_db.record_transaction(target_user_id, "admin_remove", -amount, f"Admin removal from owner")
             
-            # Remove wishes (negative amount)
-            update_user_balance(target_user_id, -amount)
-            record_transaction(target_user_id, "admin_remove", -amount, f"Admin removal from owner")
-            
-            updated_user = get_user(target_user_id)
             success_text = f"""
 ✅ **Removal Successful**
 Removed {amount} {WISH_SYMBOL} from @{target_username} (ID: {target_user_id})
@@ -551,20 +608,16 @@ Their new balance: {updated_user['wish_balance']} {WISH_SYMBOL}
                 return
             
             # Ensure target user exists
-            if not get_user(target_user_id):
-                create_user(target_user_id)
+            await async_db.ensure_user(target_user_id)
             
-            # Check if user has enough balance
-            target_user = get_user(target_user_id)
-            if target_user['wish_balance'] < amount:
+            # Remove wishes (negative amount) - fails if user doesn't have enough balance
+            updated_user = await async_db.update_user_balance(target_user_id, -amount)
+            if not updated_user:
+                target_user = await async_db.get_user(target_user_id)
                 await update.message.reply_text(f"❌ User only has {target_user['wish_balance']} {WISH_SYMBOL}, cannot remove {amount} {WISH_SYMBOL}")
                 return
+            await async_db.record_transaction(target_user_id, "admin_remove", -amount, f"Admin removal from owner")
             
-            # Remove wishes (negative amount)
-            update_user_balance(target_user_id, -amount)
-            record_transaction(target_user_id, "admin_remove", -amount, f"Admin removal from owner")
-            
-            updated_user = get_user(target_user_id)
             success_text = f"""
 ✅ **Removal Successful**
 Removed {amount} {WISH_SYMBOL} from user {target_user_id}
@@ -583,8 +636,12 @@ async def refresh_shop_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ This command is only available to the bot owner.")
         return
     
-    # Refresh the shop
-    new_cards = refresh_daily_shop()
+    # Reload the card catalog (picks up master card edits) and replace today's shop
+    await async_db.run_db(card_catalog.load)
+    new_cards = await async_db.refresh_daily_shop()
+    if not new_cards:
+        await update.message.reply_text("❌ Shop refresh failed - no cards in the catalog.")
+        return
     
     success_text = f"""
 ✅ **Shop Refreshed!**
@@ -610,16 +667,28 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("market_buy_"):
         listing_id = data.replace("market_buy_", "")
         await handle_market_purchase(query, listing_id)
+    elif data.startswith("market_next_"):
+        await handle_market_page(query, after=data.replace("market_next_", ""))
+    elif data.startswith("market_prev_"):
+        await handle_market_page(query, before=data.replace("market_prev_", ""))
+    elif data.startswith("history_older_"):
+        await show_history_page(query, older=data.replace("history_older_", ""))
+    elif data.startswith("history_newer_"):
+        await show_history_page(query, newer=data.replace("history_newer_", ""))
+    elif data.startswith("cards_page_"):
+        await show_cards_page(query, int(data.replace("cards_page_", "")))
     elif data == "shop_tab_daily":
         await show_daily_shop_tab(query)
     elif data == "shop_tab_p2p":
         await show_p2p_shop_tab(query)
+    elif data.startswith("p2p_next_"):
+        await show_p2p_shop_tab(query, after=data.replace("p2p_next_", ""))
+    elif data.startswith("p2p_prev_"):
+        await show_p2p_shop_tab(query, before=data.replace("p2p_prev_", ""))
 
 async def show_daily_shop_tab(query):
     """Show Daily Shop tab content"""
-    from shop import get_daily_shop_items
-    
-    shop_items = get_daily_shop_items()
+    shop_items = await async_db.get_daily_shop_items(query.from_user.id)
     
     if not shop_items:
         text = "🏪 **Daily Shop**\n\n🛒 The shop is empty! Come back later."
@@ -640,26 +709,29 @@ async def show_daily_shop_tab(query):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text, reply_markup=reply_markup)
 
-async def show_p2p_shop_tab(query):
-    """Show P2P Marketplace tab content"""
-    from shop import get_p2p_listings
-    
-    listings = get_p2p_listings()
+async def show_p2p_shop_tab(query, after=None, before=None):
+    """Show one page of the P2P Marketplace tab"""
+    listings, has_prev, has_next = await async_db.get_p2p_listings_page(after=after, before=before, page_size=5)
     
     if not listings:
         text = "🏪 **P2P Marketplace**\n\n🏪 No listings available! Be the first to list something."
         keyboard = [[InlineKeyboardButton("🏪 Daily Shop", callback_data="shop_tab_daily")]]
     else:
-        text = f"🏪 **P2P Marketplace**\n\n🤝 {len(listings)} items listed by players!\n\n"
+        total = await async_db.count_active_listings()
+        text = f"🏪 **P2P Marketplace**\n\n🤝 {total} items listed by players!\n\n"
         keyboard = []
         
-        for listing in listings[:5]:  # Show first 5 listings
-            text += f"• **{listing['card_id']}** - {listing['price']} 𝓒 (Seller: {listing['seller_id']})\n"
+        for listing in listings:
+            card = card_catalog.get(listing['card_id']) or UNKNOWN_CARD
+            text += f"• **{card['name']}** ({listing['card_id']}) - {listing['price']} 𝓒 (Seller: {listing['seller_id']})\n"
             keyboard.append([InlineKeyboardButton(
                 f"🛒 Buy from Player - {listing['price']} 𝓒",
                 callback_data=f"market_buy_{str(listing['_id'])}"
             )])
         
+        navigation = build_listing_navigation(listings, has_prev, has_next, "p2p")
+        if navigation:
+            keyboard.append(navigation)
         keyboard.append([InlineKeyboardButton("🏪 Daily Shop", callback_data="shop_tab_daily")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -701,9 +773,13 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     payload_parts = payment.invoice_payload.split("_")
     if len(payload_parts) >= 3 and payload_parts[0] == "wishes":
         stars_amount = int(payload_parts[2])
-        wish_amount = add_wishes_for_stars(user_id, stars_amount)
-        
-        user = get_user(user_id)
+        # The payment is already captured - make sure there is a user to credit
+        await async_db.ensure_user(user_id, update.effective_user.username)
+        wish_amount, user = await async_db.add_wishes_for_stars(user_id, stars_amount)
+        if not user:
+            logger.error(f"Could not credit {wish_amount} wishes to user {user_id} for payment {payment.telegram_payment_charge_id}")
+            await update.message.reply_text("❌ Your payment was received but we couldn't credit it. Please contact /support.")
+            return
         success_text = f"""
 ✅ **Purchase Successful!**
 +{wish_amount} {WISH_SYMBOL} added to your account!
@@ -713,66 +789,95 @@ Thank you for your purchase! 🎉
         """
         await update.message.reply_text(success_text)
 
-# Flask routes
-@app.route('/')
-def health_check():
+# ASGI routes
+async def health_check(request: Request):
     """Health check endpoint for Render"""
     from datetime import datetime as dt, timezone
-    message_count = get_message_count()
-    return {
+    message_count = await async_db.run_db(get_message_count)
+    return JSONResponse({
         'status': 'ok',
         'bot': 'VexaSwitch Store Bot',
         'message_count': message_count,
         'timestamp': dt.now(timezone.utc).isoformat()
-    }
+    })
 
-@app.route('/stats')
-def stats():
+async def stats(request: Request):
     """Stats endpoint to show bot activity"""
-    message_count = get_message_count()
-    return {
+    message_count = await async_db.run_db(get_message_count)
+    update_stats = dict(queue_stats)
+    update_stats['queue_depth'] = sum(queue.qsize() for queue in update_queues)
+    update_stats['instance'] = INSTANCE_ID
+    update_stats['queue_capacity'] = UPDATE_QUEUE_SIZE
+    update_stats['workers'] = UPDATE_WORKERS
+    return JSONResponse({
         'message_count': message_count,
+        'updates': update_stats,
+        'user_cache': user_cache.stats(),
+        'ledger': ledger.stats(),
+        'usernames': username_map.stats(),
         'status': 'Bot is awake and processing messages'
-    }
+    })
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Handle incoming webhook updates from Telegram"""
+async def webhook(request: Request):
+    """Handle incoming webhook updates from Telegram (enqueue and acknowledge immediately)"""
     try:
         # Check if bot is ready
-        if not bot_ready.is_set():
+        if not bot_running:
             logger.warning("Bot not ready yet, rejecting webhook update")
-            return Response(status=503)  # Service Unavailable
-        
-        # Increment message count to track activity
-        increment_message_count()
+            return Response(status_code=503)  # Service Unavailable
         
         # Get update from request
-        update_data = request.get_json(force=True)
-        update = Update.de_json(update_data, application.bot)
+        try:
+            update_data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        if not isinstance(update_data, dict) or 'update_id' not in update_data:
+            return Response(status_code=400)
         
-        # Process update using the bot's event loop
-        if bot_loop and bot_loop.is_running():
-            future = asyncio.run_coroutine_threadsafe(
-                application.process_update(update),
-                bot_loop
-            )
-            # Optional: monitor for exceptions
-            try:
-                from concurrent.futures import TimeoutError as FutureTimeoutError
-                future.result(timeout=0.1)  # Quick check
-            except FutureTimeoutError:
-                pass  # Normal - update is being processed asynchronously
-            except Exception as process_error:
-                logger.error(f"Error processing update: {process_error}")
-        else:
-            logger.warning("Bot loop not running, cannot process update")
-            return Response(status=503)
+        # Backpressure: Telegram retries the update later if the queue is full
+        try:
+            update_queues[update_shard(update_data)].put_nowait(update_data)
+        except asyncio.QueueFull:
+            queue_stats['rejected'] += 1
+            logger.warning("Update queue full, rejecting webhook update")
+            return Response(status_code=503)
+        queue_stats['accepted'] += 1
         
-        return Response(status=200)
+        # Increment message count to track activity (the Mongo write happens off the loop)
+        if increment_message_count(auto_flush=False):
+            run_in_background(async_db.run_db(flush_message_count))
+        return Response(status_code=200)
     except Exception as e:
         logger.error(f"Error processing webhook: {e}")
-        return Response(status=500)
+        return Response(status_code=500)
+
+def run_in_background(coro):
+    """Schedule a coroutine on the event loop and keep a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def update_shard(update_data):
+    """Pick the worker queue for an update from its sender's user_id"""
+    for value in update_data.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id', 0) % len(update_queues)
+    return update_data['update_id'] % len(update_queues)
+
+async def process_updates_worker(update_queue):
+    """Deserialize and process queued webhook updates"""
+    while True:
+        update_data = await update_queue.get()
+        try:
+            update = Update.de_json(update_data, application.bot)
+            await application.process_update(update)
+            queue_stats['processed'] += 1
+        except Exception as process_error:
+            queue_stats['failed'] += 1
+            logger.error(f"Error processing update: {process_error}")
+        finally:
+            update_queue.task_done()
 
 async def setup_webhook():
     """Set up webhook for the bot"""
@@ -818,42 +923,169 @@ async def setup_commands():
     await application.bot.set_my_commands(commands)
     logger.info("Bot commands menu set up successfully")
 
-def run_bot_loop():
-    """Run the bot's asyncio event loop in a separate thread"""
-    global bot_loop
-    bot_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(bot_loop)
+async def flush_stats_periodically():
+    """Flush the buffered message count even when traffic is idle"""
+    while True:
+        await asyncio.sleep(MESSAGE_COUNT_FLUSH_INTERVAL)
+        await async_db.run_db(flush_message_count)
+
+# --- Scheduled jobs (each runs on one instance at a time, guarded by a Mongo lease) ---
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 3600))  # seconds between archive runs
+
+async def prepare_next_shop_job():
+    """Materialize tomorrow's shop(s) before midnight UTC so the first /shop of the day is a cache load"""
+    tomorrow = shop_date(days_ahead=1)
+    await async_db.prepare_daily_shop(tomorrow)
+    if PERSONAL_SHOPS:
+        active_users = await async_db.run_db(get_active_user_ids)
+        count = await async_db.pregenerate_personal_shops(active_users, tomorrow)
+        logger.info(f"Pre-generated {count} personal shops for {tomorrow}")
+
+async def archive_transactions_job():
+    """Move old transactions to the archive tier a batch at a time"""
+    # Bounded per run so a large backlog drains over several runs
+    for _ in range(10):
+        if await async_db.run_db(archive_transactions) < ARCHIVE_BATCH_SIZE:
+            break
+
+async def warm_shop_cache_daily():
+    """Load the new day's shop into this instance's memory right after midnight (every instance)"""
+    while True:
+        await asyncio.sleep(scheduler.seconds_until_utc(0, 0, 30))
+        try:
+            await async_db.get_daily_shop_items()
+        except Exception as warm_error:
+            logger.error(f"Error loading today's shop: {warm_error}")
+
+def start_scheduled_jobs():
+    """Start the background job schedule"""
+    run_in_background(scheduler.run_daily("prepare_next_shop", prepare_next_shop_job, INSTANCE_ID, 23, 50))
+    run_in_background(scheduler.run_every("archive_transactions", archive_transactions_job, INSTANCE_ID, ARCHIVE_INTERVAL))
+    run_in_background(warm_shop_cache_daily())
+
+async def load_catalog_until_seeded():
+    """Keep retrying the card catalog load until master_cards has been seeded"""
+    while not await async_db.run_db(card_catalog.load):
+        await asyncio.sleep(CATALOG_RETRY_INTERVAL)
+    logger.info("Card catalog loaded after startup")
+
+async def flush_usernames_periodically():
+    """Write username changes seen in incoming updates"""
+    while True:
+        await asyncio.sleep(MESSAGE_COUNT_FLUSH_INTERVAL)
+        await async_db.run_db(username_map.flush)
+
+async def flush_ledger_periodically():
+    """Flush buffered ledger entries even when traffic is idle"""
+    while True:
+        await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+        await async_db.run_db(ledger.flush)
+
+async def start_bot():
+    """Prepare the database and start the bot on the server's event loop"""
+    global bot_running, update_queues
+    
+    # Make sure every query shape is backed by an index
+    if users is not None:
+        await async_db.run_db(ensure_indexes)
+        if os.getenv('VERIFY_INDEXES', '').lower() in ('1', 'true', 'yes'):
+            await async_db.run_db(verify_query_plans)
+    
+    # With several workers/instances only the lease holder does one-time setup
+    is_leader = await async_db.run_db(acquire_lease, "startup", INSTANCE_ID, STARTUP_LEASE_TTL)
+    
+    # Seed the master cards on a fresh database and run one-time backfills (no-ops once done)
+    if users is not None and is_leader:
+        await async_db.initialize_master_cards()
+        await async_db.backfill_username_lower()
+        if await async_db.card_migration_pending():
+            logger.error("Legacy card ownership found - run CONFIRM_MIGRATION=yes python migrate_card_ownership.py")
+    elif users is None:
+        logger.info("Running in demo mode - database not connected")
+    
+    # Load the master card catalog into memory (on a fresh database the leader may still be seeding it)
+    card_count = await async_db.run_db(card_catalog.load)
+    if users is not None and not card_count and not is_leader:
+        for _ in range(CATALOG_WAIT_SECONDS):
+            await asyncio.sleep(1)
+            card_count = await async_db.run_db(card_catalog.load)
+            if card_count:
+                break
+    logger.info(f"Card catalog loaded with {card_count} cards")
+    if users is not None and not card_count:
+        run_in_background(load_catalog_until_seeded())
     
+    # Initialize the application
+    await application.initialize()
+    await application.start()
+    if is_leader:
+        await setup_commands()
+        await setup_webhook()
+    else:
+        logger.info("Webhook and commands are registered by another worker")
+    
+    # Start update workers and periodically write the buffered message count to Mongo
+    queue_size = max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)
+    update_queues = [asyncio.Queue(maxsize=queue_size) for _ in range(UPDATE_WORKERS)]
+    for update_queue in update_queues:
+        run_in_background(process_updates_worker(update_queue))
+    run_in_background(flush_stats_periodically())
+    run_in_background(flush_ledger_periodically())
+    run_in_background(flush_usernames_periodically())
+    if users is not None:
+        start_scheduled_jobs()
+    
+    bot_running = True
+    logger.info(f"VexaSwitch Store Bot initialized and ready on port {PORT}")
+    print(f"\n✅ Bot is running on http://0.0.0.0:{PORT}")
+    print(f"📊 Health check: http://0.0.0.0:{PORT}/")
+    print(f"📈 Stats: http://0.0.0.0:{PORT}/stats")
+    print(f"🔗 Webhook: {WEBHOOK_URL}")
+
+async def stop_bot():
+    """Drain queued updates, stop background tasks and shut the bot down gracefully"""
+    global bot_running
+    # Stop accepting webhook updates (Telegram retries 503s), then finish the ones
+    # already acknowledged - they won't be resent, and some are payments
+    bot_running = False
     try:
-        # Initialize the application
-        bot_loop.run_until_complete(application.initialize())
-        bot_loop.run_until_complete(application.start())
-        bot_loop.run_until_complete(setup_commands())
-        bot_loop.run_until_complete(setup_webhook())
-        
-        # Signal that the bot is ready
-        bot_ready.set()
-        logger.info("Bot event loop initialized and running")
-        
-        # Keep the loop running
-        bot_loop.run_forever()
-    except Exception as e:
-        logger.error(f"Critical error in bot loop: {e}")
-        # Signal failure so the app can handle it
-        bot_ready.set()
-        raise
+        await asyncio.wait_for(
+            asyncio.gather(*(queue.join() for queue in update_queues)),
+            timeout=SHUTDOWN_DRAIN_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        dropped = sum(queue.qsize() for queue in update_queues)
+        logger.error(f"Shutdown drain timed out with {dropped} queued updates unprocessed")
+    
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    
+    await async_db.run_db(flush_message_count)
+    await async_db.run_db(ledger.flush)
+    await async_db.run_db(username_map.flush)
+    try:
+        await application.stop()
+        await application.shutdown()
+    except Exception as shutdown_error:
+        logger.error(f"Error during shutdown: {shutdown_error}")
+    async_db.shutdown_executor()
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the bot with the ASGI server and stop it on shutdown"""
+    if not initialize_bot():
+        yield
+        return
+    await start_bot()
+    try:
+        yield
     finally:
-        # Graceful shutdown
-        try:
-            bot_loop.run_until_complete(application.stop())
-            bot_loop.run_until_complete(application.shutdown())
-        except Exception as shutdown_error:
-            logger.error(f"Error during shutdown: {shutdown_error}")
-        bot_loop.close()
+        await stop_bot()
 
 def initialize_bot():
-    """Initialize bot handlers and webhook"""
-    global bot_thread
+    """Register bot handlers (returns False in demo mode)"""
     
     # Check if running in demo mode
     if BOT_TOKEN.startswith("demo_mode"):
@@ -872,16 +1104,11 @@ def initialize_bot():
         print("2. Set MONGODB_URL environment variable with your MongoDB connection string")
         print("3. Set WEBHOOK_URL environment variable with your webhook URL")
         print("4. Restart the bot")
-        return
-    
-    # Initialize database if connected
-    if users is not None and not get_user(1):  # Check if database is initialized
-        initialize_default_shop()
-        logger.info("Database initialized with sample data")
-    elif users is None:
-        logger.info("Running in demo mode - database not connected")
+        return False
     
     # Add handlers
+    # Runs before every other handler group to keep the username map current
+    application.add_handler(TypeHandler(Update, track_usernames), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("vault", vault))
@@ -912,29 +1139,18 @@ def initialize_bot():
     application.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
     
-    # Start bot loop in separate thread
-    bot_thread = threading.Thread(target=run_bot_loop, daemon=True)
-    bot_thread.start()
-    
-    # Wait for bot to be ready (with timeout)
-    logger.info("Waiting for bot to initialize...")
-    if bot_ready.wait(timeout=30):
-        if bot_loop and bot_loop.is_running():
-            logger.info(f"VexaSwitch Store Bot initialized and ready on port {PORT}")
-            print(f"\n✅ Bot is running on http://0.0.0.0:{PORT}")
-            print(f"📊 Health check: http://0.0.0.0:{PORT}/")
-            print(f"📈 Stats: http://0.0.0.0:{PORT}/stats")
-            print(f"🔗 Webhook: {WEBHOOK_URL}")
-        else:
-            logger.error("Bot initialization failed - loop not running")
-            raise RuntimeError("Bot failed to start properly")
-    else:
-        logger.error("Bot initialization timeout (30 seconds)")
-        raise RuntimeError("Bot initialization timeout")
+    return True
+
+# Create ASGI app - the bot and the web server share one event loop
+app = Starlette(
+    routes=[
+        Route('/', health_check),
+        Route('/stats', stats),
+        Route('/webhook', webhook, methods=['POST']),
+    ],
+    lifespan=lifespan
+)
 
 if __name__ == '__main__':
-    # Initialize the bot
-    initialize_bot()
-    
-    # Run Flask app
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    # Run the ASGI app (the bot starts in the lifespan handler)
+    uvicorn.run(app, host='0.0.0.0', port=PORT)
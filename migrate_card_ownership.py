@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Script to migrate card ownership to the counted owned_cards model.
+
+Folds the legacy one-document-per-copy user_cards collection and the
+users.collection arrays into one owned_cards document per (user_id, card_id),
+then prints a storage and query-latency comparison. Safe to re-run, including
+after a failure part-way: each owned_cards document records that it received
+its legacy count, so a retried batch skips documents it already updated, and a
+marker in the migrations collection skips the whole script once it finishes.
+"""
+import os
+import time
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from utils import db, users, user_cards, owned_cards
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+MIGRATION_ID = "card_ownership_v1"
+BATCH_SIZE = 1000
+
+def _storage(collection_name):
+    """Get (data size, index size) in bytes for a collection"""
+    if collection_name not in db.list_collection_names():
+        return 0, 0
+    stats = db.command("collStats", collection_name)
+    return stats.get("size", 0), stats.get("totalIndexSize", 0)
+
+def _sample_latency_ms(query_fn, user_ids):
+    """Average time of query_fn over a sample of users, in milliseconds"""
+    if not user_ids:
+        return 0.0
+    start = time.perf_counter()
+    for user_id in user_ids:
+        query_fn(user_id)
+    return (time.perf_counter() - start) * 1000 / len(user_ids)
+
+def _legacy_counts():
+    """Get {(user_id, card_id): count} summed over user_cards and users.collection"""
+    counts = {}
+    for user_id, card_id, count in _legacy_groups():
+        counts[(user_id, card_id)] = counts.get((user_id, card_id), 0) + count
+    return counts
+
+def _legacy_groups():
+    """Yield (user_id, card_id, count) from user_cards and users.collection"""
+    for doc in user_cards.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "card_id": "$card_id"}, "count": {"$sum": 1}}}
+    ], allowDiskUse=True):
+        yield doc["_id"]["user_id"], doc["_id"]["card_id"], doc["count"]
+
+    for doc in users.aggregate([
+        {"$match": {"collection.0": {"$exists": True}}},
+        {"$unwind": "$collection"},
+        {"$match": {"collection": {"$ne": None}}},
+        {"$group": {"_id": {"user_id": "$user_id", "card_id": "$collection"}, "count": {"$sum": 1}}}
+    ], allowDiskUse=True):
+        yield doc["_id"]["user_id"], doc["_id"]["card_id"], doc["count"]
+
+def _apply_batch(batch):
+    """Write one batch, returns how many documents received their legacy count"""
+    try:
+        result = owned_cards.bulk_write(batch, ordered=False)
+    except BulkWriteError as e:
+        # A duplicate key means the document was already migrated by an earlier, interrupted run
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        return e.details["nModified"] + e.details["nUpserted"]
+    return result.modified_count + result.upserted_count
+
+def migrate():
+    """Add legacy counts to owned_cards in batches (once per document), then retire the legacy stores"""
+    now = datetime.utcnow()
+    batch = []
+    written = 0
+    for (user_id, card_id), count in _legacy_counts().items():
+        # The migrated guard makes a retried batch a no-op for documents it already updated;
+        # for those the filter misses and the upsert hits the unique index instead
+        batch.append(UpdateOne(
+            {"user_id": user_id, "card_id": card_id, "migrated": {"$ne": MIGRATION_ID}},
+            {"$inc": {"count": count}, "$set": {"migrated": MIGRATION_ID}, "$setOnInsert": {"obtained_at": now}},
+            upsert=True
+        ))
+        if len(batch) >= BATCH_SIZE:
+            written += _apply_batch(batch)
+            batch = []
+    if batch:
+        written += _apply_batch(batch)
+
+    # Both steps are idempotent, and the marker goes last so a failure here is retried too
+    users.update_many({"collection": {"$exists": True}}, {"$unset": {"collection": ""}})
+    if "user_cards" in db.list_collection_names():
+        user_cards.rename("user_cards_legacy", dropTarget=True)
+    db.migrations.update_one(
+        {"_id": MIGRATION_ID},
+        {"$set": {"completed_at": datetime.utcnow(), "upserts": written}},
+        upsert=True
+    )
+    return written
+
+def main():
+    print("🔄 Migrating card ownership to the counted owned_cards model")
+
+    if db is None:
+        print("❌ Database not connected. Please set MONGODB_URL environment variable.")
+        return
+
+    if db.migrations.find_one({"_id": MIGRATION_ID}):
+        print("✅ Migration already applied - nothing to do")
+        return
+
+    confirm = os.getenv("CONFIRM_MIGRATION", "")
+    if confirm.lower() != "yes":
+        print("❌ Operation cancelled. Set CONFIRM_MIGRATION=yes environment variable to proceed.")
+        print("   Example: CONFIRM_MIGRATION=yes python migrate_card_ownership.py")
+        return
+
+    sample_users = user_cards.distinct("user_id")[:50]
+    legacy_size, legacy_index_size = _storage("user_cards")
+    legacy_latency = _sample_latency_ms(lambda user_id: list(user_cards.find({"user_id": user_id})), sample_users)
+
+    owned_cards.create_index([("user_id", 1), ("card_id", 1)], unique=True)
+    written = migrate()
+
+    new_size, new_index_size = _storage("owned_cards")
+    new_latency = _sample_latency_ms(
+        lambda user_id: list(owned_cards.find({"user_id": user_id, "count": {"$gte": 1}})), sample_users
+    )
+
+    print(f"✅ Wrote {written} ownership upserts")
+    print(f"   Storage: {legacy_size + legacy_index_size} bytes (user_cards) -> "
+          f"{new_size + new_index_size} bytes (owned_cards)")
+    print(f"   Collection read over {len(sample_users)} users: "
+          f"{legacy_latency:.2f} ms -> {new_latency:.2f} ms per user")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import async_db
+from utils import acquire_lease
+
+logger = logging.getLogger(__name__)
+
+def seconds_until_utc(hour, minute=0, second=0):
+    """Seconds from now until the next hh:mm:ss UTC"""
+    now = datetime.utcnow()
+    target = now.replace(hour=hour, minute=minute, second=second, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+async def run_job(name, job, owner, lease_ttl):
+    """Run an async job if this instance wins its lease (jobs must be safe to re-run).
+
+    Errors - including failing to reach Mongo for the lease - are logged, never
+    raised, so one bad run can't stop the schedule loop.
+    """
+    try:
+        if not await async_db.run_db(acquire_lease, f"job:{name}", owner, lease_ttl):
+            return False
+        await job()
+        logger.info(f"Scheduled job {name} finished")
+    except Exception as job_error:
+        logger.error(f"Scheduled job {name} failed: {job_error}")
+    return True
+
+async def run_daily(name, job, owner, hour, minute=0, second=0):
+    """Run a job once a day at hh:mm:ss UTC on one instance.
+
+    The lease is kept for an hour, so instances whose clocks are a little
+    behind skip the run instead of repeating it.
+    """
+    while True:
+        await asyncio.sleep(seconds_until_utc(hour, minute, second))
+        await run_job(name, job, owner, lease_ttl=3600)
+
+async def run_every(name, job, owner, interval):
+    """Run a job every `interval` seconds on one instance"""
+    while True:
+        await asyncio.sleep(interval)
+        # Slightly shorter than the interval so the next run isn't blocked by this lease
+        await run_job(name, job, owner, lease_ttl=interval * 0.9)
@@ -1,17 +1,35 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import os
 import random
 import datetime
+import threading
+import time
 
 # --- Import database connections from utils.py ---
-from utils import master_cards, p2p_listings, users, db
+from utils import p2p_listings, users, db, card_catalog, encode_cursor, decode_cursor, keyset_filter
 
-# --- Daily shop collection ---
+# --- Daily shop collections ---
 if db is not None:
     daily_shop = db.daily_shop
+    personal_shops = db.personal_shops  # One shop per (user_id, date), expired by a TTL index
 else:
-    daily_shop = None
+    daily_shop = personal_shops = None
+
+# Give every player their own daily rotation instead of one global shop
+PERSONAL_SHOPS = os.getenv('PERSONAL_SHOPS', '').lower() in ('1', 'true', 'yes')
+PERSONAL_SHOP_TTL = datetime.timedelta(days=2)  # Kept past midnight so late buy buttons still work
+
+# Today's global shop, cached until the date rolls over
+_daily_shop_lock = threading.Lock()
+_daily_shop_cache = (None, None)  # (date, cards), swapped as one tuple
+
+def shop_date(days_ahead=0):
+    """Shop rotation date (UTC) as an ISO string"""
+    return (datetime.datetime.utcnow().date() + datetime.timedelta(days=days_ahead)).isoformat()
 
 # --- Rarity Mapping & Pricing ---
 RARITY_MAP = {
@@ -60,69 +78,185 @@ def get_rarity_color_text(rarity):
     }
     return colors.get(rarity, "<i>Mysterious</i>")
 
-# Use utils.get_user and utils.create_user instead of duplicating user creation logic
+# Use utils.ensure_user instead of duplicating user creation logic
 
 # --- Shop Logic ---
-def get_daily_shop_items():
-    if daily_shop is None:
-        return []  # Demo mode - no database available
-    today = datetime.date.today().isoformat()
-    shop = daily_shop.find_one({"date": today})
-    if shop:
-        return shop["cards"]
-
+def _build_shop_cards(rng=random):
+    """Pick one card per rarity tier and price it"""
     cards = []
     for rarity_num in RARITY_ORDER:
         rarity_name, _ = RARITY_MAP[rarity_num]
         # Search for uppercase rarity to match database format
-        available_cards = list(master_cards.find({"rarity": rarity_name.upper()}))
+        available_cards = card_catalog.by_rarity(rarity_name.upper())
         
         if available_cards:
-            # Select a random card from available cards
-            card = random.choice(available_cards)
+            # Select a random card from available cards (copied - catalog cards are shared)
+            card = dict(rng.choice(available_cards))
             low, high = RARITY_PRICE_RANGES[rarity_name]
-            card["price"] = random.randint(low, high)
+            card["price"] = rng.randint(low, high)
             cards.append(card)
+    return cards
 
-    daily_shop.update_one(
-        {"date": today},
-        {"$set": {"cards": cards, "date": today}},
-        upsert=True
-    )
+def get_daily_shop_items(user_id=None):
+    if daily_shop is None:
+        return []  # Demo mode - no database available
+    if PERSONAL_SHOPS and user_id is not None:
+        return get_personal_shop_items(user_id)
+    global _daily_shop_cache
+    today = shop_date()
+    cached_date, cached_cards = _daily_shop_cache
+    if cached_date == today:
+        return cached_cards
+
+    # Single-flight: one thread per process generates, the rest wait for its result
+    with _daily_shop_lock:
+        cached_date, cached_cards = _daily_shop_cache
+        if cached_date == today:
+            return cached_cards
+        cards = _materialize_daily_shop(today)
+        if cards:
+            _daily_shop_cache = (today, cards)
+        return cards
+
+def refresh_daily_shop():
+    """Replace today's global shop with a fresh rotation (owner /refreshshop)"""
+    global _daily_shop_cache
+    if daily_shop is None:
+        return []
+    today = shop_date()
+    cards = _build_shop_cards()
+    if not cards:
+        return []  # Catalog not seeded - keep the current shop
+    with _daily_shop_lock:
+        daily_shop.replace_one({"date": today}, {"date": today, "cards": cards}, upsert=True)
+        _daily_shop_cache = (today, cards)
     return cards
 
-def buy_from_default_shop(user_id, card_id):
-    from utils import get_user, create_user
-    user = get_user(user_id)
-    if not user:
-        create_user(user_id)
-        user = get_user(user_id)
-    today = datetime.date.today().isoformat()
+def prepare_daily_shop(date):
+    """Create the global shop for a future date ahead of time (no-op if it already exists)"""
+    if daily_shop is None:
+        return []
+    return _materialize_daily_shop(date)
+
+def _materialize_daily_shop(today):
+    """Load today's shop, creating it if missing - the first writer across processes wins"""
     shop = daily_shop.find_one({"date": today})
-    if not shop:
-        return False, "Shop not available."
+    if shop:
+        return shop["cards"]
+    cards = _build_shop_cards()
+    if not cards:
+        # Catalog not seeded yet - never store an empty shop, it would win for the whole day
+        return []
+    try:
+        shop = daily_shop.find_one_and_update(
+            {"date": today},
+            {"$setOnInsert": {"cards": cards, "date": today}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Another process inserted it between our find and upsert
+        shop = daily_shop.find_one({"date": today})
+    return shop["cards"]
+
+# --- Personal daily shops ---
+def generate_personal_shop(user_id, date):
+    """Build a user's shop for a date - the same (user_id, date) always gives the same cards"""
+    return _build_shop_cards(random.Random(f"{user_id}:{date}"))
+
+def _personal_shop_doc(user_id, date):
+    expires_at = datetime.datetime.combine(datetime.date.fromisoformat(date), datetime.time()) + PERSONAL_SHOP_TTL
+    return {
+        "_id": f"{user_id}:{date}",
+        "user_id": user_id,
+        "date": date,
+        "cards": generate_personal_shop(user_id, date),
+        "expires_at": expires_at
+    }
+
+def get_personal_shop_items(user_id):
+    """Get a user's shop for today, generating it on first visit"""
+    today = shop_date()
+    shop = personal_shops.find_one({"_id": f"{user_id}:{today}"})
+    if shop:
+        return shop["cards"]
+
+    doc = _personal_shop_doc(user_id, today)
+    if not doc["cards"]:
+        return []  # Catalog not seeded yet - don't store an empty shop
+    # $setOnInsert keeps whichever copy was stored first, and we always serve that one
+    try:
+        shop = personal_shops.find_one_and_update(
+            {"_id": doc["_id"]},
+            {"$setOnInsert": doc},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        shop = personal_shops.find_one({"_id": doc["_id"]})
+    return shop["cards"]
+
+def pregenerate_personal_shops(user_ids, date=None, batch_size=1000):
+    """Generate shops for many users ahead of time with batched bulk_write upserts"""
+    if personal_shops is None:
+        return 0
+    date = date or shop_date()
+    written = 0
+    batch = []
+    for user_id in user_ids:
+        doc = _personal_shop_doc(user_id, date)
+        if not doc["cards"]:
+            return written  # Catalog not seeded yet
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": doc}, upsert=True))
+        if len(batch) >= batch_size:
+            personal_shops.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+    if batch:
+        personal_shops.bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
 
-    card = next((c for c in shop["cards"] if c["card_id"] == card_id), None)
+def buy_from_default_shop(user_id, card_id):
+    from utils import ensure_user
+    ensure_user(user_id)
+    if PERSONAL_SHOPS:
+        shop_cards = get_personal_shop_items(user_id)
+    else:
+        shop_cards = get_daily_shop_items()
+        if not shop_cards:
+            return False, "Shop not available."
+
+    card = next((c for c in shop_cards if c["card_id"] == card_id), None)
     if not card:
         return False, "Card not in today’s shop."
 
-    if user['wish_balance'] < card['price']:
-        return False, "Not enough currency."
+    from utils import add_card_to_user, cache_user, run_in_transaction, AbortTransaction
+
+    def settle(session):
+        # The debit fails atomically if the user can't afford the card
+        updated_user = users.find_one_and_update(
+            {"user_id": user_id, "wish_balance": {"$gte": card['price']}},
+            {"$inc": {"wish_balance": -card['price']}},
+            session=session,
+            return_document=ReturnDocument.AFTER
+        )
+        if not updated_user:
+            raise AbortTransaction("Not enough currency.")
+        add_card_to_user(user_id, card_id, session=session)
+        return updated_user
 
-    users.update_one(
-        {"user_id": user_id},
-        {"$inc": {"wish_balance": -card['price']}, "$push": {"collection": card_id}}
-    )
+    try:
+        cache_user(run_in_transaction(settle))
+    except AbortTransaction as e:
+        return False, str(e)
     return True, card
 
 # --- P2P Logic ---
 def create_p2p_listing(user_id, card_id, price):
-    from utils import get_user, create_user
-    user = get_user(user_id)
-    if not user:
-        create_user(user_id)
-        user = get_user(user_id)
-    if card_id not in user.get("collection", []):
+    from utils import ensure_user, user_owns_card
+    ensure_user(user_id)
+    if not user_owns_card(user_id, card_id):
         return None, "You don't own this card."
 
     listing = {
@@ -138,38 +272,95 @@ def create_p2p_listing(user_id, card_id, price):
 def buy_from_p2p(buyer_id, listing_id):
     if p2p_listings is None:
         return False, "P2P marketplace not available in demo mode."
-    listing = p2p_listings.find_one({"_id": listing_id, "is_active": True})
-    if not listing:
-        return False, "Listing not found."
-
-    from utils import get_user, create_user
-    buyer = get_user(buyer_id)
-    if not buyer:
-        create_user(buyer_id)
-        buyer = get_user(buyer_id)
-    seller = get_user(listing['seller_id'])
-    if not seller:
-        create_user(listing['seller_id'])
-        seller = get_user(listing['seller_id'])
-    if buyer['wish_balance'] < listing['price']:
-        return False, "Not enough currency."
-
-    # transfer currency and ownership
-    users.update_one({"user_id": buyer_id}, {"$inc": {"wish_balance": -listing['price']}, "$push": {"collection": listing['card_id']}})
-    users.update_one({"user_id": seller['user_id']}, {"$inc": {"wish_balance": listing['price']}, "$pull": {"collection": listing['card_id']}})
-    p2p_listings.update_one({"_id": listing_id}, {"$set": {"is_active": False}})
-
-    return True, listing
-
-def get_p2p_listings():
-    """Get all active P2P listings"""
+
+    from utils import ensure_user, execute_p2p_purchase, transfer_card
+    ensure_user(buyer_id)
+    # Claim, payment, card transfer and ledger entries run in one transaction
+    return execute_p2p_purchase(buyer_id, listing_id, transfer_card)
+
+# --- P2P listing pages (keyset pagination on created_at, _id) ---
+LISTING_COUNT_TTL = 30  # seconds the active listing count is cached
+_listing_count_cache = {"value": 0, "expires": 0.0}
+
+def encode_listing_cursor(listing):
+    """Encode a listing's (created_at, _id) position for callback data"""
+    return encode_cursor(listing, "created_at")
+
+def get_p2p_listings_page(after=None, before=None, page_size=5):
+    """Get one page of active listings ordered by (created_at, _id).
+
+    Pass the cursor of the last listing shown as `after` for the next page, or of
+    the first listing shown as `before` for the previous one.
+    Returns (listings, has_prev, has_next).
+    """
     if p2p_listings is None:
-        return []
-    return list(p2p_listings.find({"is_active": True}))
+        return [], False, False
+
+    query = {"is_active": True}
+    cursor = after or before
+    if cursor:
+        created_at, listing_id = decode_cursor(cursor)
+        query.update(keyset_filter("created_at", created_at, listing_id, forward=bool(after)))
+
+    direction = 1 if not before else -1
+    listings = list(
+        p2p_listings.find(query)
+        .sort([("created_at", direction), ("_id", direction)])
+        .limit(page_size + 1)
+    )
+    has_more = len(listings) > page_size
+    listings = listings[:page_size]
+
+    if before:
+        listings.reverse()
+        return listings, has_more, True
+    return listings, after is not None, has_more
+
+def count_active_listings():
+    """Count active listings (cached for LISTING_COUNT_TTL seconds)"""
+    if p2p_listings is None:
+        return 0
+    now = time.monotonic()
+    if now >= _listing_count_cache["expires"]:
+        _listing_count_cache["value"] = p2p_listings.count_documents({"is_active": True})
+        _listing_count_cache["expires"] = now + LISTING_COUNT_TTL
+    return _listing_count_cache["value"]
+
+# --- Marketplace rendering ---
+MARKET_PAGE_SIZE = 5
+UNKNOWN_CARD = {"name": "Unknown", "rarity": "Unknown", "series": "Unknown", "image_url": ""}
+
+def build_listing_navigation(listings, has_prev, has_next, prefix):
+    """Build Prev/Next buttons carrying keyset cursors for a page of listings"""
+    navigation = []
+    if listings and has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}_prev_{encode_listing_cursor(listings[0])}"))
+    if listings and has_next:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}_next_{encode_listing_cursor(listings[-1])}"))
+    return navigation
+
+def build_market_page(listings, total, has_prev, has_next):
+    """Render one page of P2P listings as a single HTML message with buy and navigation buttons"""
+    text = f"🏪 <b>P2P MARKETPLACE</b> 🏪\n🤝 {total} Cards Listed!\n\n"
+    keyboard = []
+    for listing in listings:
+        # Card metadata comes from the in-memory catalog - no query per listing
+        card = card_catalog.get(listing['card_id']) or UNKNOWN_CARD
+        rarity_emoji = get_rarity_emoji(card['rarity'])
+        text += f"{rarity_emoji} <b>{card['name']}</b> - {listing['price']} 𝓒\n"
+        text += f"📺 {card.get('series', 'Unknown')} | 💎 {card['rarity']}\n"
+        text += f"🆔 <code>{listing['card_id']}</code> | 👤 {listing['seller_id']}\n\n"
+        keyboard.append([InlineKeyboardButton(f"🛒 Buy {card['name']} - {listing['price']} 𝓒", callback_data=f"market_buy_{str(listing['_id'])}")])
+
+    navigation = build_listing_navigation(listings, has_prev, has_next, "market")
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(keyboard)
 
 # --- Telegram Handlers ---
 async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    shop_items = get_daily_shop_items()
+    import async_db
+    shop_items = await async_db.get_daily_shop_items(update.effective_user.id)
     if not shop_items:
         await update.message.reply_text("🛒 The shop is empty! Come back later.")
         return
@@ -201,34 +392,25 @@ async def show_market(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if p2p_listings is None:
         await update.message.reply_text("🏪 **P2P Marketplace**\n\n⚠️ Marketplace is not available in demo mode. Please configure MONGODB_URL to enable trading features.")
         return
-    listings = list(p2p_listings.find({"is_active": True}))
+    import async_db
+    listings, has_prev, has_next = await async_db.get_p2p_listings_page(page_size=MARKET_PAGE_SIZE)
     if not listings:
         await update.message.reply_text("🏪 The marketplace is empty! Be the first to list something with /sell.")
         return
 
-    await update.message.reply_text(f"🏪 **P2P MARKETPLACE** 🏪\n🤝 {len(listings)} Cards Listed!")
-    for listing in listings[:10]:
-        card = master_cards.find_one({"card_id": listing['card_id']}) or {"name": "Unknown", "rarity": "Unknown", "series": "Unknown", "image_url": ""}
-        rarity_emoji = get_rarity_emoji(card['rarity'])
-        rarity_color = get_rarity_color_text(card['rarity'])
-        card_text = f"""
-{rarity_emoji} <b>{card['name']}</b> {rarity_emoji}
-{rarity_color}
-
-📺 <b>Series:</b> {card.get('series', 'Unknown')}
-💎 <b>Rarity:</b> {card['rarity']}
-💰 <b>Price:</b> {listing['price']} 𝓒
-🆔 <b>ID:</b> <code>{listing['card_id']}</code>
-👤 <b>Seller:</b> {listing['seller_id']}
-        """.strip()
-
-        keyboard = [[InlineKeyboardButton(f"🛒 Buy {card['name']} - {listing['price']} 𝓒", callback_data=f"market_buy_{str(listing['_id'])}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        if card.get('image_url'):
-            await update.message.reply_photo(photo=card['image_url'], caption=card_text, reply_markup=reply_markup, parse_mode='HTML')
-        else:
-            await update.message.reply_text(card_text, reply_markup=reply_markup, parse_mode='HTML')
+    total = await async_db.count_active_listings()
+    text, reply_markup = build_market_page(listings, total, has_prev, has_next)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def handle_market_page(query, after=None, before=None):
+    import async_db
+    listings, has_prev, has_next = await async_db.get_p2p_listings_page(after=after, before=before, page_size=MARKET_PAGE_SIZE)
+    if not listings:
+        await query.edit_message_text("🏪 No more listings! Use /market to start from the beginning.")
+        return
+    total = await async_db.count_active_listings()
+    text, reply_markup = build_market_page(listings, total, has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
 
 async def sell_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
@@ -239,8 +421,9 @@ async def sell_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if price <= 0:
             await update.message.reply_text("Price must be positive!")
             return
+        import async_db
         user_id = update.effective_user.id
-        listing_id, msg = create_p2p_listing(user_id, card_id, price)
+        listing_id, msg = await async_db.create_p2p_listing(user_id, card_id, price)
         if not listing_id:
             await update.message.reply_text(f"❌ {msg}")
             return
@@ -249,24 +432,24 @@ async def sell_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid price!")
 
 async def handle_shop_purchase(query, card_id):
-    from utils import get_user
+    import async_db
     user_id = query.from_user.id
-    success, result = buy_from_default_shop(user_id, card_id)
+    success, result = await async_db.buy_from_default_shop(user_id, card_id)
     if success:
         card = result
-        user = get_user(user_id)
+        user = await async_db.get_user(user_id)
         await query.edit_message_text(f"✅ You bought {card['name']} ({card['rarity']}) for {card['price']} 𝓒. Balance: {user['wish_balance']} 𝓒")
     else:
         await query.edit_message_text(f"❌ {result}")
 
 async def handle_market_purchase(query, listing_id):
     try:
-        from utils import get_user
+        import async_db
         buyer_id = query.from_user.id
         object_id = ObjectId(listing_id)
-        success, result = buy_from_p2p(buyer_id, object_id)
+        success, result = await async_db.buy_from_p2p(buyer_id, object_id)
         if success:
-            buyer = get_user(buyer_id)
+            buyer = await async_db.get_user(buyer_id)
             await query.edit_message_text(f"✅ You bought {result['card_id']} for {result['price']} 𝓒. Balance: {buyer['wish_balance']} 𝓒")
         else:
             await query.edit_message_text(f"❌ {result}")
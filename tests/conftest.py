@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from ledger import LedgerWriter
+
+
+class AtomicCollection:
+    """Wraps a mongomock collection so each operation runs atomically, like a single-document
+    write on a real server. The code under test still interleaves freely between operations."""
+
+    _lock = threading.RLock()
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                result = attr(*args, **kwargs)
+                # Materialize cursors while holding the lock
+                return list(result) if isinstance(result, mongomock.collection.Cursor) else result
+        return locked
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Point utils at an in-memory database on a standalone (no transactions) server"""
+    database = mongomock.MongoClient().telegram_bot
+    collections = {}
+    for name in ("users", "transactions", "p2p_listings", "owned_cards"):
+        collections[name] = AtomicCollection(database[name])
+        monkeypatch.setattr(utils, name, collections[name])
+    monkeypatch.setattr(utils, "db", database)
+    monkeypatch.setattr(utils, "_transactions_supported", False)
+    monkeypatch.setattr(utils, "ledger", LedgerWriter(collections["transactions"], batch_size=1000, flush_interval=3600))
+    utils.user_cache.clear()
+    yield collections
+    utils.user_cache.clear()
+
+
+def run_concurrently(target, args_list):
+    """Start every call at the same moment on its own thread and collect the results in order"""
+    barrier = threading.Barrier(len(args_list))
+    results = [None] * len(args_list)
+    errors = []
+
+    def worker(index, args):
+        barrier.wait()
+        try:
+            results[index] = target(*args)
+        except Exception as e:  # pragma: no cover - surfaced by the assertion below
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    return results
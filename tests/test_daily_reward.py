@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+
+import utils
+from conftest import run_concurrently
+
+
+def ledger_entries(user_id):
+    utils.ledger.flush()
+    return list(utils.transactions.find({"user_id": user_id, "type": "daily_reward"}))
+
+
+def test_concurrent_claims_credit_once(db):
+    db["users"].insert_one({"user_id": 1, "wish_balance": 50, "last_daily_claim": None})
+
+    results = run_concurrently(utils.claim_daily_reward, [(1, 10)] * 20)
+
+    assert sum(1 for user in results if user) == 1
+    assert db["users"].find_one({"user_id": 1})["wish_balance"] == 60
+    assert len(ledger_entries(1)) == 1
+
+
+def test_claim_reopens_after_cooldown(db):
+    last_claim = datetime.utcnow() - utils.DAILY_COOLDOWN - timedelta(minutes=1)
+    db["users"].insert_one({"user_id": 1, "wish_balance": 50, "last_daily_claim": last_claim})
+
+    results = run_concurrently(utils.claim_daily_reward, [(1, 10)] * 10)
+
+    assert sum(1 for user in results if user) == 1
+    assert utils.claim_daily_reward(1, 10) is None
+    assert db["users"].find_one({"user_id": 1})["wish_balance"] == 60
+    assert len(ledger_entries(1)) == 1
@@ -0,0 +1,63 @@
+import time
+
+import mongomock
+
+import utils
+from ledger import LedgerWriter
+
+EVENTS = 2000
+BATCH_SIZE = 100
+# mongomock answers in-process, so each call is charged a simulated network round-trip
+ROUND_TRIP_SECONDS = 0.0005
+
+
+class RoundTripCollection:
+    """Wraps a mongomock collection, sleeping once per call and counting the calls"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            time.sleep(ROUND_TRIP_SECONDS)
+            return attr(*args, **kwargs)
+        return call
+
+
+def entries():
+    return [utils.build_transaction(user_id % 50, "daily_reward", 10, "Daily reward claimed") for user_id in range(EVENTS)]
+
+
+def events_per_second(write):
+    collection = RoundTripCollection(mongomock.MongoClient().telegram_bot.transactions)
+    docs = entries()
+    start = time.perf_counter()
+    write(collection, docs)
+    elapsed = time.perf_counter() - start
+    assert collection._collection.count_documents({}) == EVENTS
+    return EVENTS / elapsed, collection.calls
+
+
+def test_batched_ledger_outpaces_one_insert_per_event():
+    def one_insert_per_event(collection, docs):
+        for doc in docs:
+            collection.insert_one(doc)
+
+    def batched(collection, docs):
+        ledger = LedgerWriter(collection, batch_size=BATCH_SIZE, flush_interval=3600)
+        for doc in docs:
+            ledger.append(doc)
+        ledger.flush()
+
+    single_rate, single_calls = events_per_second(one_insert_per_event)
+    batched_rate, batched_calls = events_per_second(batched)
+
+    print(f"insert_one: {single_rate:.0f} events/s in {single_calls} writes; "
+          f"insert_many: {batched_rate:.0f} events/s in {batched_calls} writes")
+    assert single_calls == EVENTS
+    assert batched_calls == EVENTS // BATCH_SIZE
+    assert batched_rate > 3 * single_rate
@@ -0,0 +1,116 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+import utils
+from conftest import run_concurrently
+
+PRICE = 50
+
+
+def make_user(db, user_id, balance):
+    db["users"].insert_one({"user_id": user_id, "username": f"user{user_id}", "wish_balance": balance})
+
+
+def make_listing(db, seller_id, card_id="card_1", price=PRICE):
+    listing_id = ObjectId()
+    db["p2p_listings"].insert_one({
+        "_id": listing_id, "seller_id": seller_id, "card_id": card_id,
+        "price": price, "is_active": True, "created_at": datetime.utcnow()
+    })
+    return listing_id
+
+
+def balances(db):
+    return {user["user_id"]: user["wish_balance"] for user in db["users"].find()}
+
+
+def card_count(db, user_id, card_id="card_1"):
+    return utils.get_user_card_count(user_id, card_id)
+
+
+def test_concurrent_buyers_only_one_wins(db):
+    seller = 1
+    buyers = list(range(100, 120))
+    make_user(db, seller, 0)
+    for buyer in buyers:
+        make_user(db, buyer, 100)
+    utils.add_card_to_user(seller, "card_1")
+    listing_id = make_listing(db, seller)
+    total_before = sum(balances(db).values())
+
+    results = run_concurrently(
+        utils.execute_p2p_purchase,
+        [(buyer, listing_id, utils.transfer_card) for buyer in buyers]
+    )
+
+    winners = [buyer for buyer, (ok, _) in zip(buyers, results) if ok]
+    assert len(winners) == 1
+    winner = winners[0]
+    after = balances(db)
+    assert sum(after.values()) == total_before
+    assert after[seller] == PRICE
+    assert after[winner] == 100 - PRICE
+    assert all(after[buyer] == 100 for buyer in buyers if buyer != winner)
+    assert card_count(db, seller) == 0
+    assert card_count(db, winner) == 1
+    listing = db["p2p_listings"].find_one({"_id": listing_id})
+    assert listing["is_active"] is False and listing["buyer_id"] == winner
+    assert db["transactions"].count_documents({}) == 2
+
+
+def test_missing_card_compensates_buyer_and_listing(db):
+    seller, buyer = 1, 2
+    make_user(db, seller, 0)
+    make_user(db, buyer, 100)
+    listing_id = make_listing(db, seller)  # The seller no longer owns the card
+
+    ok, message = utils.execute_p2p_purchase(buyer, listing_id, utils.transfer_card)
+
+    assert not ok and message == "Seller no longer owns this card"
+    assert balances(db) == {seller: 0, buyer: 100}
+    listing = db["p2p_listings"].find_one({"_id": listing_id})
+    assert listing["is_active"] is True
+    assert "buyer_id" not in listing and "sold_at" not in listing
+    assert db["transactions"].count_documents({}) == 0
+
+
+def test_insufficient_balance_releases_listing(db):
+    seller, buyer = 1, 2
+    make_user(db, seller, 0)
+    make_user(db, buyer, PRICE - 1)
+    utils.add_card_to_user(seller, "card_1")
+    listing_id = make_listing(db, seller)
+
+    ok, message = utils.execute_p2p_purchase(buyer, listing_id, utils.transfer_card)
+
+    assert not ok and message == "Insufficient wishes"
+    assert balances(db) == {seller: 0, buyer: PRICE - 1}
+    assert db["p2p_listings"].find_one({"_id": listing_id})["is_active"] is True
+    assert card_count(db, seller) == 1
+
+
+def test_double_listed_card_sells_once_under_contention(db):
+    # One copy listed twice: buyers race on both listings, only one sale can settle
+    seller = 1
+    buyers = list(range(100, 116))
+    make_user(db, seller, 0)
+    for buyer in buyers:
+        make_user(db, buyer, 100)
+    utils.add_card_to_user(seller, "card_1")
+    listings = [make_listing(db, seller), make_listing(db, seller)]
+    total_before = sum(balances(db).values())
+
+    results = run_concurrently(
+        utils.execute_p2p_purchase,
+        [(buyer, listings[i % 2], utils.transfer_card) for i, buyer in enumerate(buyers)]
+    )
+
+    assert sum(1 for ok, _ in results if ok) == 1
+    after = balances(db)
+    assert sum(after.values()) == total_before
+    assert after[seller] == PRICE
+    assert card_count(db, seller) + sum(card_count(db, buyer) for buyer in buyers) == 1
+    # The listing whose sale was compensated is back on the market
+    assert db["p2p_listings"].count_documents({"is_active": True}) == 1
+    assert db["transactions"].count_documents({}) == 2
@@ -0,0 +1,46 @@
+import time
+
+import mongomock
+import pytest
+
+import shop
+import utils
+from catalog import CardCatalog
+
+USERS = 100_000
+# Generation is pure CPU over the in-memory catalog (~3-4s locally); the budget
+# leaves room for slow CI machines while still catching an accidental Mongo
+# round-trip or per-call catalog rebuild
+BUDGET_SECONDS = 20
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Seed the master cards into an in-memory database and load the catalog"""
+    master_cards = mongomock.MongoClient().telegram_bot.master_cards
+    card_catalog = CardCatalog(master_cards)
+    monkeypatch.setattr(utils, "master_cards", master_cards)
+    monkeypatch.setattr(utils, "card_catalog", card_catalog)
+    monkeypatch.setattr(shop, "card_catalog", card_catalog)
+    utils.initialize_master_cards()
+    return card_catalog
+
+
+def test_personal_shop_is_deterministic(catalog):
+    first = [shop.generate_personal_shop(user_id, "2026-01-01") for user_id in range(100)]
+    again = [shop.generate_personal_shop(user_id, "2026-01-01") for user_id in range(100)]
+    next_day = [shop.generate_personal_shop(user_id, "2026-01-02") for user_id in range(100)]
+
+    assert first == again
+    assert first != next_day
+    assert all(len(cards) == len(shop.RARITY_ORDER) for cards in first)
+
+
+def test_personal_shops_for_100k_users_within_budget(catalog):
+    start = time.perf_counter()
+    for user_id in range(USERS):
+        shop.generate_personal_shop(user_id, "2026-01-01")
+    elapsed = time.perf_counter() - start
+
+    print(f"Generated {USERS} personal shops in {elapsed:.2f}s")
+    assert elapsed < BUDGET_SECONDS
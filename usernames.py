@@ -0,0 +1,100 @@
+import threading
+from pymongo import UpdateMany, UpdateOne
+from cache import LRUCache
+
+class UsernameMap:
+    """Bidirectional username <-> user_id map kept current from incoming updates.
+
+    observe() is called for every update and only touches memory; username
+    changes are queued and written to the users collection by flush() in one
+    bulk_write. resolve() serves @username lookups from memory and falls back
+    to Mongo on a miss. Usernames are matched case-insensitively, in memory and
+    in Mongo through the normalized username_lower field. Entries expire after
+    ttl seconds so a name another worker saw move is re-read from Mongo.
+    """
+
+    def __init__(self, collection, maxsize=10000, ttl=None):
+        self._collection = collection
+        self._ids = LRUCache(maxsize, ttl)    # lowercase username -> user_id
+        self._names = LRUCache(maxsize, ttl)  # user_id -> username
+        self._pending = {}               # user_id -> username not yet written
+        self._lock = threading.Lock()
+        self.flushed = 0
+
+    def observe(self, user_id, username):
+        """Record the username Telegram reported for a user"""
+        if not username or self._names.get(user_id) == username:
+            return
+        with self._lock:
+            old = self._names.get(user_id)
+            if old and self._ids.get(old.lower()) == user_id:
+                self._ids.pop(old.lower())
+            holder = self._ids.get(username.lower())
+            if holder is not None and holder != user_id:
+                self._names.pop(holder)  # Telegram usernames are unique - the name moved
+            self._names.set(user_id, username)
+            self._ids.set(username.lower(), user_id)
+            # Re-insert so flush() sees changes in the order they were observed
+            self._pending.pop(user_id, None)
+            self._pending[user_id] = username
+
+    def cached_id(self, username):
+        """Get a user_id from memory only (None on a miss)"""
+        return self._ids.get(username.lstrip("@").lower())
+
+    def resolve(self, username):
+        """Get the user_id for a username, querying Mongo on a cache miss"""
+        username = username.lstrip("@")
+        user_id = self.cached_id(username)
+        if user_id is not None or self._collection is None:
+            return user_id
+        user = self._collection.find_one({"username_lower": username.lower()}, {"user_id": 1, "username": 1})
+        if not user:
+            return None
+        with self._lock:
+            self._names.set(user["user_id"], user["username"])
+            self._ids.set(username.lower(), user["user_id"])
+        return user["user_id"]
+
+    def flush(self):
+        """Write queued username changes with one unordered bulk_write"""
+        if self._collection is None:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        # If a name moved between users within the batch only its latest holder keeps it
+        holders = {username.lower(): user_id for user_id, username in pending.items()}
+
+        # Users are created by ensure_user, so this only refreshes existing documents.
+        # A username belongs to one account at a time, so it is cleared from whoever
+        # held it before.
+        requests = []
+        for lower, user_id in holders.items():
+            username = pending[user_id]
+            requests.append(UpdateMany(
+                {"username_lower": lower, "user_id": {"$ne": user_id}},
+                {"$unset": {"username": "", "username_lower": ""}}
+            ))
+            requests.append(UpdateOne(
+                {"user_id": user_id, "$or": [{"username": {"$ne": username}}, {"username_lower": {"$ne": lower}}]},
+                {"$set": {"username": username, "username_lower": lower}}
+            ))
+        try:
+            self._collection.bulk_write(requests, ordered=False)
+        except Exception as e:
+            with self._lock:
+                for user_id, username in pending.items():
+                    self._pending.setdefault(user_id, username)
+            print(f"Error flushing usernames: {e}")
+            return 0
+        self.flushed += len(holders)
+        return len(holders)
+
+    def stats(self):
+        """Get cache and flush counters for /stats"""
+        with self._lock:
+            pending = len(self._pending)
+        return {'lookups': self._ids.stats(), 'pending': pending, 'flushed': self.flushed}
@@ -1,8 +1,16 @@
 import os
+import time
 import random
+import threading
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
 from dotenv import load_dotenv
+from catalog import CardCatalog
+from cache import LRUCache
+from ledger import LedgerWriter
+from usernames import UsernameMap
 
 # Load environment variables
 load_dotenv()
@@ -22,165 +30,207 @@ if client:
     # Collections
     users = db.users
     transactions = db.transactions
-    default_shop = db.default_shop
+    transactions_archive = db.transactions_archive  # Rows older than ARCHIVE_AFTER_DAYS
+    transaction_summaries = db.transaction_summaries  # Per-user monthly totals of archived rows
     p2p_listings = db.p2p_listings
-    user_cards = db.user_cards
+    owned_cards = db.owned_cards  # One document per (user_id, card_id) with a copy count
+    user_cards = db.user_cards  # Legacy one-document-per-copy store (see migrate_card_ownership.py)
     master_cards = db.master_cards  # Master collection of all available waifu cards
 else:
-    db = users = transactions = default_shop = p2p_listings = user_cards = master_cards = None
-
-def create_user(user_id, username=None):
-    """Create a new user or return existing user"""
+    db = users = transactions = transactions_archive = transaction_summaries = None
+    p2p_listings = owned_cards = user_cards = master_cards = None
+
+# Process-wide in-memory copy of master_cards (no Mongo round-trips for card lookups)
+card_catalog = CardCatalog(master_cards)
+
+# Read-through user cache, refreshed from write results and invalidated on other writes.
+# With several workers/instances another process can change a user, so USER_CACHE_SHARED
+# switches to a short TTL that bounds how stale a cached user can be. It turns on by itself
+# when gunicorn runs more than one worker (WEB_CONCURRENCY > 1).
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+if (os.getenv('USER_CACHE_SHARED', '').lower() in ('1', 'true', 'yes')
+        or int(os.getenv('WEB_CONCURRENCY', 1)) > 1):
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 2))
+else:
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Transaction ledger - entries are buffered and written in batches with insert_many
+LEDGER_BATCH_SIZE = int(os.getenv('LEDGER_BATCH_SIZE', 100))
+LEDGER_FLUSH_INTERVAL = float(os.getenv('LEDGER_FLUSH_INTERVAL', 5))  # seconds
+ledger = LedgerWriter(transactions, LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL)
+
+# username <-> user_id map for @username lookups, refreshed from every incoming update.
+# Shares the user cache TTL so names that moved in another process are re-read.
+username_map = UsernameMap(users, USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def cache_user(user):
+    """Store a user document (e.g. a find_one_and_update post-image) in the cache"""
+    if user:
+        user_cache.set(user["user_id"], user)
+    return user
+
+def invalidate_user(*user_ids):
+    """Drop users from the cache after a write that didn't return the new document"""
+    for user_id in user_ids:
+        user_cache.pop(user_id)
+
+def ensure_user(user_id, username=None):
+    """Get a user, creating them first if they don't exist (single upsert round-trip)"""
     if users is None:
         print("Database not connected - using placeholder data")
         return {"user_id": user_id, "username": username, "wish_balance": 100, "last_daily_claim": None}
     
-    existing_user = users.find_one({"user_id": user_id})
-    if existing_user:
-        return existing_user
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
     
-    user_data = {
-        "user_id": user_id,
-        "username": username,
-        "wish_balance": 50,
-        "last_daily_claim": None,
-        "dice_uses_today": 0,
-        "last_dice_reset": datetime.utcnow().date().isoformat(),
-        "created_at": datetime.utcnow()
-    }
-    users.insert_one(user_data)
-    return user_data
+    now = datetime.utcnow()
+    try:
+        user = users.find_one_and_update(
+            {"user_id": user_id},
+            {"$setOnInsert": {
+                "username": username,
+                "username_lower": username.lower() if username else None,
+                "wish_balance": 50,
+                "last_daily_claim": None,
+                "dice_uses_today": 0,
+                "last_dice_reset": now.date().isoformat(),
+                "created_at": now
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent first message inserted this user first (unique user_id index)
+        user = users.find_one({"user_id": user_id})
+    return cache_user(user)
+
+def create_user(user_id, username=None):
+    """Create a new user or return existing user"""
+    return ensure_user(user_id, username)
+
+def backfill_username_lower():
+    """Store the normalized username_lower on users created before it existed (runs once)"""
+    if users is None or db.migrations.find_one({"_id": "username_lower_v1"}):
+        return 0
+    result = users.update_many(
+        {"username": {"$type": "string"}, "username_lower": {"$exists": False}},
+        [{"$set": {"username_lower": {"$toLower": "$username"}}}]
+    )
+    db.migrations.update_one(
+        {"_id": "username_lower_v1"},
+        {"$set": {"completed_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return result.modified_count
+
+def card_migration_pending():
+    """Check whether legacy card ownership still has to be moved by migrate_card_ownership.py"""
+    if users is None or db.migrations.find_one({"_id": "card_ownership_v1"}):
+        return False
+    return (user_cards.find_one({}, {"_id": 1}) is not None
+            or users.find_one({"collection.0": {"$exists": True}}, {"_id": 1}) is not None)
 
 def get_user(user_id):
     """Get user by ID"""
     if users is None:
         print("Database not connected - using placeholder data")
         return {"user_id": user_id, "wish_balance": 100, "last_daily_claim": None}
-    return users.find_one({"user_id": user_id})
+    
+    user = user_cache.get(user_id)
+    if user is None:
+        user = cache_user(users.find_one({"user_id": user_id}))
+    return user
 
 def update_user_balance(user_id, amount):
-    """Update user's wish balance (can be positive or negative)"""
+    """Atomically update user's wish balance (can be positive or negative) and return the updated user"""
     if users is None:
         print(f"Database not connected - would update user {user_id} balance by {amount}")
-        return True
-        
-    user = get_user(user_id)
-    if not user:
-        return False
-    
-    new_balance = user["wish_balance"] + amount
-    if new_balance < 0:
-        return False  # Prevent negative balance
+        return {"user_id": user_id, "wish_balance": 100 + amount, "last_daily_claim": None}
     
-    users.update_one(
-        {"user_id": user_id},
-        {"$set": {"wish_balance": new_balance}}
-    )
-    return True
+    # The balance filter prevents negative balances without a prior read;
+    # returns None if the user doesn't exist or can't afford the change
+    return cache_user(users.find_one_and_update(
+        {"user_id": user_id, "wish_balance": {"$gte": -amount}},
+        {"$inc": {"wish_balance": amount}},
+        return_document=ReturnDocument.AFTER
+    ))
 
-def can_claim_daily(user_id):
-    """Check if user can claim daily reward"""
-    if users is None:
-        print("Database not connected - allowing daily claim")
-        return True
-        
-    user = get_user(user_id)
-    if not user:
-        return False
-    
-    if not user.get("last_daily_claim"):
-        return True
-    
-    last_claim = user["last_daily_claim"]
-    if isinstance(last_claim, str):
-        last_claim = datetime.fromisoformat(last_claim)
-    
-    time_since_claim = datetime.utcnow() - last_claim
-    return time_since_claim >= timedelta(hours=24)
+DAILY_COOLDOWN = timedelta(hours=24)
 
-def can_use_dice(user_id):
-    """Check if user can use dice (4 times per day)"""
-    if users is None:
-        print("Database not connected - allowing dice use")
-        return True
-        
-    user = get_user(user_id)
-    if not user:
-        return False
-    
-    # Get current date
-    today = datetime.utcnow().date().isoformat()
-    
-    # Check if it's a new day, reset counter if so
-    if user.get("last_dice_reset") != today:
-        users.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "dice_uses_today": 0,
-                    "last_dice_reset": today
-                }
-            }
-        )
-        return True
-    
-    # Check if user has dice uses left (max 4 per day)
-    dice_uses = user.get("dice_uses_today", 0)
-    return dice_uses < 4
+DICE_DAILY_LIMIT = 4
 
-def use_dice(user_id):
-    """Use one dice attempt (increment counter)"""
+def roll_dice(user_id, reward_amount):
+    """Use one dice attempt and credit its reward in a single atomic update.
+
+    Returns the updated user (with dice_uses_today and wish_balance), or None
+    if the user has already used all their dice today.
+    """
     if users is None:
-        print(f"Database not connected - would use dice for user {user_id}")
-        return True
-        
-    user = get_user(user_id)
-    if not user:
-        return False
+        print(f"Database not connected - would roll dice for user {user_id}")
+        return {"user_id": user_id, "wish_balance": 100 + reward_amount, "dice_uses_today": 1}
     
-    # Get current date
     today = datetime.utcnow().date().isoformat()
+    # The filter enforces the daily limit; the pipeline resets the counter on a new day,
+    # counts this roll and credits the reward in the same write
+    user = users.find_one_and_update(
+        {
+            "user_id": user_id,
+            "$or": [
+                {"last_dice_reset": {"$ne": today}},
+                {"dice_uses_today": {"$lt": DICE_DAILY_LIMIT}},
+                {"dice_uses_today": {"$exists": False}}
+            ]
+        },
+        [{"$set": {
+            "dice_uses_today": {"$cond": [
+                {"$eq": ["$last_dice_reset", today]},
+                {"$add": [{"$ifNull": ["$dice_uses_today", 0]}, 1]},
+                1
+            ]},
+            "last_dice_reset": today,
+            "wish_balance": {"$add": ["$wish_balance", reward_amount]}
+        }}],
+        return_document=ReturnDocument.AFTER
+    )
+    if not user:
+        return None
     
-    # Reset counter if it's a new day
-    if user.get("last_dice_reset") != today:
-        users.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "dice_uses_today": 1,
-                    "last_dice_reset": today
-                }
-            }
-        )
-    else:
-        # Increment dice uses
-        users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"dice_uses_today": 1}}
-        )
-    
-    return True
+    cache_user(user)
+    record_transaction(user_id, "dice_reward", reward_amount, "Random dice reward")
+    return user
 
 def claim_daily_reward(user_id, amount=10):
-    """Claim daily reward and update last claim time"""
-    if not can_claim_daily(user_id):
-        return False
-    
+    """Claim daily reward in one conditional update, returns the updated user (None if on cooldown)"""
     if users is None:
         print(f"Demo mode: Would claim {amount} daily reward for user {user_id}")
-        return True
+        return {"user_id": user_id, "wish_balance": 100 + amount, "last_daily_claim": datetime.utcnow()}
     
-    users.update_one(
-        {"user_id": user_id},
+    now = datetime.utcnow()
+    # Only matches if the last claim is older than the cooldown, never happened,
+    # or is a legacy non-date value - so a double tap credits exactly once
+    user = users.find_one_and_update(
+        {
+            "user_id": user_id,
+            "$or": [
+                {"last_daily_claim": {"$lt": now - DAILY_COOLDOWN}},
+                {"last_daily_claim": {"$not": {"$type": "date"}}}
+            ]
+        },
         {
             "$inc": {"wish_balance": amount},
-            "$set": {"last_daily_claim": datetime.utcnow()}
-        }
+            "$set": {"last_daily_claim": now}
+        },
+        return_document=ReturnDocument.AFTER
     )
+    if not user:
+        return None
     
+    cache_user(user)
     # Record transaction
     record_transaction(user_id, "daily_reward", amount, "Daily reward claim")
-    return True
+    return user
 
 def reset_all_vaults():
     """Reset all users' wish balances to 0"""
@@ -193,6 +243,7 @@ def reset_all_vaults():
             {},  # Empty filter to match all documents
             {"$set": {"wish_balance": 0}}
         )
+        user_cache.clear()
         print(f"Reset {result.modified_count} user vaults to 0")
         return True
     except Exception as e:
@@ -205,37 +256,60 @@ def transfer_wishes(from_user_id, to_user_id, amount):
         print(f"Demo mode: Would transfer {amount} wishes from {from_user_id} to {to_user_id}")
         return True
         
-    from_user = get_user(from_user_id)
-    if not from_user or from_user["wish_balance"] < amount:
-        return False
-    
     # Ensure target user exists
-    create_user(to_user_id)
-    
-    # Perform transfer
-    users.update_one({"user_id": from_user_id}, {"$inc": {"wish_balance": -amount}})
-    users.update_one({"user_id": to_user_id}, {"$inc": {"wish_balance": amount}})
-    
-    # Record transactions
-    record_transaction(from_user_id, "transfer_out", -amount, f"Transfer to user {to_user_id}")
-    record_transaction(to_user_id, "transfer_in", amount, f"Transfer from user {from_user_id}")
+    ensure_user(to_user_id)
+    
+    def settle(session):
+        # The debit fails atomically if the sender can't afford it
+        sender = users.find_one_and_update(
+            {"user_id": from_user_id, "wish_balance": {"$gte": amount}},
+            {"$inc": {"wish_balance": -amount}},
+            session=session,
+            return_document=ReturnDocument.AFTER
+        )
+        if not sender:
+            raise AbortTransaction("Insufficient wishes")
+        receiver = users.find_one_and_update(
+            {"user_id": to_user_id},
+            {"$inc": {"wish_balance": amount}},
+            session=session,
+            return_document=ReturnDocument.AFTER
+        )
+        # Balances and ledger entries commit together
+        ledger.write_now([
+            build_transaction(from_user_id, "transfer_out", -amount, f"Transfer to user {to_user_id}"),
+            build_transaction(to_user_id, "transfer_in", amount, f"Transfer from user {from_user_id}"),
+        ], session=session)
+        return sender, receiver
     
+    try:
+        sender, receiver = run_in_transaction(settle)
+    except AbortTransaction:
+        return False
+    cache_user(sender)
+    cache_user(receiver)
     return True
 
+def build_transaction(user_id, transaction_type, amount, description):
+    """Build a transaction document"""
+    now = datetime.utcnow()
+    return {
+        "_id": ObjectId(),  # Assigned up front so buffered entries already have a stable keyset position
+        "user_id": user_id,
+        "type": transaction_type,
+        "amount": amount,
+        "description": description,
+        # Millisecond precision like BSON dates, so buffered and stored entries sort the same
+        "timestamp": now.replace(microsecond=now.microsecond // 1000 * 1000)
+    }
+
 def record_transaction(user_id, transaction_type, amount, description):
     """Record a transaction"""
     if transactions is None:
         print(f"Database not connected - would record transaction: {user_id} {transaction_type} {amount} {description}")
         return
         
-    transaction = {
-        "user_id": user_id,
-        "type": transaction_type,
-        "amount": amount,
-        "description": description,
-        "timestamp": datetime.utcnow()
-    }
-    transactions.insert_one(transaction)
+    ledger.append(build_transaction(user_id, transaction_type, amount, description))
 
 def get_user_transactions(user_id, limit=10):
     """Get user's transaction history"""
@@ -246,27 +320,161 @@ def get_user_transactions(user_id, limit=10):
             {"timestamp": datetime.utcnow(), "amount": 10, "description": "Demo transaction"},
             {"timestamp": datetime.utcnow(), "amount": -5, "description": "Demo purchase"}
         ]
-    return list(transactions.find({"user_id": user_id}).sort("timestamp", -1).limit(limit))
+    history = list(transactions.find({"user_id": user_id}).sort("timestamp", -1).limit(limit))
+    # Include entries still buffered in the ledger writer
+    pending = ledger.pending_for(user_id)
+    if pending:
+        history = sorted(history + pending, key=lambda tx: tx["timestamp"], reverse=True)[:limit]
+    return history
+
+# Only the fields /history renders (plus _id for the keyset cursor)
+HISTORY_PROJECTION = {"timestamp": 1, "amount": 1, "description": 1}
+
+# Keyset pagination on (datetime field, _id), shared by /history and the P2P market pages
+def encode_cursor(doc, field):
+    """Encode a document's (field, _id) position as "<ms>_<oid>" for callback data"""
+    moment_ms = (doc[field] - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+    return f"{moment_ms}_{doc['_id']}"
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor into (datetime, ObjectId)"""
+    moment_ms, doc_id = cursor.split("_", 1)
+    return datetime(1970, 1, 1) + timedelta(milliseconds=int(moment_ms)), ObjectId(doc_id)
+
+def keyset_filter(field, moment, doc_id, forward):
+    """Match documents after (forward) or before a (field, _id) position"""
+    op = "$gt" if forward else "$lt"
+    return {"$or": [
+        {field: {op: moment}},
+        {field: moment, "_id": {op: doc_id}},
+    ]}
+
+def encode_transaction_cursor(tx):
+    """Encode a transaction's (timestamp, _id) position for callback data"""
+    return encode_cursor(tx, "timestamp")
+
+def _after_cursor(tx, timestamp, tx_id, newer):
+    """Check a buffered entry against a keyset cursor the same way the Mongo query does"""
+    if newer:
+        return (tx["timestamp"], tx["_id"]) > (timestamp, tx_id)
+    return (tx["timestamp"], tx["_id"]) < (timestamp, tx_id)
+
+def get_user_transactions_page(user_id, older=None, newer=None, page_size=10):
+    """Get one page of a user's history, newest first, keyed on (timestamp, _id).
+
+    Pass the cursor of the last entry shown as `older` to page back in time, or
+    of the first entry shown as `newer` to page forward.
+    Returns (entries, has_newer, has_older).
+    """
+    if transactions is None:
+        return get_user_transactions(user_id, page_size), False, False
+
+    query = {"user_id": user_id}
+    cursor = older or newer
+    if cursor:
+        timestamp, tx_id = decode_cursor(cursor)
+        query.update(keyset_filter("timestamp", timestamp, tx_id, forward=bool(newer)))
+
+    direction = 1 if newer else -1
+    sort = [("timestamp", direction), ("_id", direction)]
+    entries = list(transactions.find(query, HISTORY_PROJECTION).sort(sort).limit(page_size + 1))
+    # Archived rows are older than every hot row, so a full page going back in time never needs them
+    if newer or len(entries) <= page_size:
+        archived = list(transactions_archive.find(query, HISTORY_PROJECTION).sort(sort).limit(page_size + 1))
+        if archived:
+            entries = sorted(entries + archived, key=lambda tx: (tx["timestamp"], tx["_id"]), reverse=not newer)
+    # Include entries still buffered in the ledger writer
+    pending = ledger.pending_for(user_id)
+    if cursor:
+        pending = [tx for tx in pending if _after_cursor(tx, timestamp, tx_id, newer)]
+    if pending:
+        entries = sorted(entries + pending, key=lambda tx: (tx["timestamp"], tx["_id"]), reverse=not newer)
+    has_more = len(entries) > page_size
+    entries = entries[:page_size]
+
+    if newer:
+        entries.reverse()
+        return entries, has_more, True
+    return entries, older is not None, has_more
+
+# Transaction archive - hot rows older than ARCHIVE_AFTER_DAYS move to transactions_archive
+# in batches, and their amounts are rolled into per-user monthly summaries
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+SUMMARY_BATCH_HISTORY = 50  # archive batch ids remembered per summary to make re-applied batches no-ops
+
+def _summary_updates(docs):
+    """Build idempotent summary updates for archived rows, one per (user_id, month, archive_batch).
+
+    Each summary remembers the archive batches it has counted, so re-running a
+    batch after a crash can't count its rows twice.
+    """
+    totals = {}
+    for tx in docs:
+        key = (tx["user_id"], tx["timestamp"].strftime("%Y-%m"), tx["archive_batch"])
+        total = totals.setdefault(key, {"count": 0, "net": 0, "credited": 0, "debited": 0})
+        total["count"] += 1
+        total["net"] += tx["amount"]
+        total["credited" if tx["amount"] > 0 else "debited"] += abs(tx["amount"])
+
+    requests = []
+    for (user_id, month, batch_id), total in totals.items():
+        # Create the summary if needed, then apply the batch only if it isn't recorded yet
+        requests.append(UpdateOne({"user_id": user_id, "month": month}, {"$setOnInsert": {"batches": []}}, upsert=True))
+        requests.append(UpdateOne(
+            {"user_id": user_id, "month": month, "batches": {"$ne": batch_id}},
+            {"$inc": total, "$push": {"batches": {"$each": [batch_id], "$slice": -SUMMARY_BATCH_HISTORY}}}
+        ))
+    return requests
+
+def archive_transactions(batch_size=None):
+    """Move one batch of old transactions to the archive tier, returns the number moved"""
+    if transactions is None:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    docs = list(transactions.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", 1).limit(batch_size or ARCHIVE_BATCH_SIZE))
+    if not docs:
+        return 0
+
+    def move(session):
+        batch_id = ObjectId()
+        for doc in docs:
+            doc["archive_batch"] = batch_id
+        try:
+            transactions_archive.insert_many(docs, ordered=False, session=session)
+        except BulkWriteError as e:
+            # Without a transaction a crashed run can leave rows in both tiers. Those rows keep the
+            # batch id they were archived under, so the summary step below skips them if it already ran.
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            duplicate_ids = [docs[err["index"]]["_id"] for err in errors]
+            archived = {
+                doc["_id"]: doc.get("archive_batch")
+                for doc in transactions_archive.find({"_id": {"$in": duplicate_ids}}, {"archive_batch": 1}, session=session)
+            }
+            for doc in docs:
+                doc["archive_batch"] = archived.get(doc["_id"], batch_id) or batch_id
+        # Ordered - each summary must exist before its guarded $inc
+        transaction_summaries.bulk_write(_summary_updates(docs), ordered=True, session=session)
+        transactions.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}}, session=session)
+        return len(docs)
+
+    return run_in_transaction(move)
+
+def get_user_monthly_summaries(user_id, limit=12):
+    """Get a user's monthly totals for archived transactions, newest month first"""
+    if transaction_summaries is None:
+        return []
+    return list(transaction_summaries.find({"user_id": user_id}, {"_id": 0, "batches": 0}).sort("month", -1).limit(limit))
 
 def add_wishes_for_stars(user_id, stars_amount, conversion_rate=10):
-    """Add wishes when user buys with Telegram Stars"""
+    """Add wishes when user buys with Telegram Stars, returns (wish_amount, updated user or None)"""
     wish_amount = stars_amount * conversion_rate
-    update_user_balance(user_id, wish_amount)
-    record_transaction(user_id, "stars_purchase", wish_amount, f"Purchased {wish_amount} wishes with {stars_amount} stars")
-    return wish_amount
-
-# Rarity pricing ranges
-RARITY_PRICING = {
-    "LIMITED EDITION": (3000, 4000),
-    "ZENITH": (1000, 2000),
-    "RETRO": (250, 300),
-    "MYTHIC": (50, 100),
-    "LEGENDARY": (25, 49),
-    "EPIC": (15, 24),
-    "RARE": (8, 14),
-    "UNCOMMON": (3, 7),
-    "COMMON": (1, 2)
-}
+    user = update_user_balance(user_id, wish_amount)
+    if user:
+        record_transaction(user_id, "stars_purchase", wish_amount, f"Purchased {wish_amount} wishes with {stars_amount} stars")
+    return wish_amount, user
 
 def initialize_master_cards():
     """Initialize master cards database with comprehensive waifu collection"""
@@ -352,107 +560,10 @@ def initialize_master_cards():
     for card in master_waifu_cards:
         card["created_at"] = datetime.utcnow()
         master_cards.insert_one(card)
+    card_catalog.load()
     
     print(f"Initialized {len(master_waifu_cards)} waifu cards in master collection!")
 
-def get_random_price_for_rarity(rarity):
-    """Get a random price within the range for a given rarity"""
-    if rarity in RARITY_PRICING:
-        min_price, max_price = RARITY_PRICING[rarity]
-        return random.randint(min_price, max_price)
-    return 1  # Default fallback
-
-def refresh_daily_shop(shop_size=9):
-    """Refresh the daily shop with random cards and pricing"""
-    # Clear existing shop
-    default_shop.delete_many({})
-    
-    # Get all available cards from master collection
-    all_cards = list(master_cards.find())
-    if not all_cards:
-        initialize_master_cards()
-        all_cards = list(master_cards.find())
-    
-    # Rarity weights for shop selection (higher weight = more likely to appear)
-    rarity_weights = {
-        "COMMON": 35,
-        "UNCOMMON": 25, 
-        "RARE": 20,
-        "EPIC": 10,
-        "LEGENDARY": 5,
-        "MYTHIC": 3,
-        "RETRO": 1.5,
-        "ZENITH": 0.4,
-        "LIMITED EDITION": 0.1
-    }
-    
-    # Select random cards for shop with weighted rarity
-    selected_cards = []
-    
-    for _ in range(shop_size):
-        # Select rarity based on weights
-        rarities = list(rarity_weights.keys())
-        weights = list(rarity_weights.values())
-        selected_rarity = random.choices(rarities, weights=weights)[0]
-        
-        # Get cards of selected rarity
-        rarity_cards = [card for card in all_cards if card["rarity"] == selected_rarity]
-        
-        if rarity_cards:
-            selected_card = random.choice(rarity_cards)
-            # Create shop item with random pricing
-            shop_item = {
-                "card_id": selected_card["card_id"],
-                "name": selected_card["name"],
-                "rarity": selected_card["rarity"],
-                "price": get_random_price_for_rarity(selected_card["rarity"]),
-                "image_url": selected_card["image_url"],
-                "series": selected_card.get("series", "Unknown"),
-                "date_added": datetime.utcnow()
-            }
-            selected_cards.append(shop_item)
-    
-    # Insert selected cards into shop
-    if selected_cards:
-        default_shop.insert_many(selected_cards)
-        print(f"Daily shop refreshed with {len(selected_cards)} new cards!")
-    
-    return selected_cards
-
-def initialize_default_shop():
-    """Initialize default shop by refreshing with random cards"""
-    # First make sure master cards exist
-    if master_cards.count_documents({}) == 0:
-        initialize_master_cards()
-    
-    # Then refresh the shop
-    refresh_daily_shop()
-
-def get_default_shop_items():
-    """Get all items in default shop"""
-    return list(default_shop.find())
-
-def buy_from_default_shop(user_id, card_id):
-    """Buy a card from default shop"""
-    card = default_shop.find_one({"card_id": card_id})
-    if not card:
-        return False, "Card not found"
-    
-    user = get_user(user_id)
-    if not user or user["wish_balance"] < card["price"]:
-        return False, "Insufficient wishes"
-    
-    # Deduct wishes
-    users.update_one({"user_id": user_id}, {"$inc": {"wish_balance": -card["price"]}})
-    
-    # Add card to user's collection
-    add_card_to_user(user_id, card_id, card["name"], card["rarity"])
-    
-    # Record transaction
-    record_transaction(user_id, "shop_purchase", -card["price"], f"Bought {card['name']} from shop")
-    
-    return True, card
-
 def create_p2p_listing(user_id, card_id, price):
     """Create a P2P marketplace listing"""
     # Check if user owns the card
@@ -478,50 +589,105 @@ def create_p2p_listing(user_id, card_id, price):
     result = p2p_listings.insert_one(listing)
     return str(result.inserted_id), "Listing created successfully"
 
-def get_p2p_listings():
-    """Get all active P2P listings"""
-    return list(p2p_listings.find({"is_active": True}))
-
 def get_user_listings(user_id):
     """Get all listings by a specific user"""
     return list(p2p_listings.find({"seller_id": user_id, "is_active": True}))
 
+# --- Multi-document transactions ---
+class AbortTransaction(Exception):
+    """Raised inside a transaction callback to abort it with a user-facing message"""
+
+_transactions_supported = None
+
+def supports_transactions():
+    """Check once whether the server is a replica set or mongos (required for transactions)"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        try:
+            hello = client.admin.command("hello")
+            _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            print(f"Could not detect transaction support: {e}")
+            _transactions_supported = False
+    return _transactions_supported
+
+def run_in_transaction(callback):
+    """Run callback(session) in a multi-document transaction.
+
+    On standalone servers the callback runs with session=None and must undo
+    its own writes if it fails part-way.
+    """
+    if supports_transactions():
+        with client.start_session() as session:
+            return session.with_transaction(callback)
+    return callback(None)
+
+def execute_p2p_purchase(buyer_id, listing_id, move_card):
+    """Claim a P2P listing and settle it atomically.
+
+    move_card(seller_id, buyer_id, card_id, session) transfers one copy of the
+    card and returns False if the seller no longer owns it (see transfer_card).
+    Returns (True, listing) or (False, error message).
+    """
+    if p2p_listings is None:
+        return False, "P2P marketplace not available in demo mode."
+    
+    def settle(session):
+        undo = []  # Compensating writes, only used without a transaction
+        try:
+            # Claim the listing - only one buyer can flip is_active from True to False
+            listing = p2p_listings.find_one_and_update(
+                {"_id": listing_id, "is_active": True, "seller_id": {"$ne": buyer_id}},
+                {"$set": {"is_active": False, "buyer_id": buyer_id, "sold_at": datetime.utcnow()}},
+                session=session,
+                return_document=ReturnDocument.AFTER
+            )
+            if not listing:
+                own = p2p_listings.find_one({"_id": listing_id, "is_active": True, "seller_id": buyer_id}, session=session)
+                raise AbortTransaction("Cannot buy your own listing" if own else "Listing not found")
+            undo.append(lambda: p2p_listings.update_one(
+                {"_id": listing_id},
+                {"$set": {"is_active": True}, "$unset": {"buyer_id": "", "sold_at": ""}}
+            ))
+            
+            price = listing["price"]
+            seller_id = listing["seller_id"]
+            
+            # Debit the buyer only if they can afford it
+            if not users.find_one_and_update(
+                {"user_id": buyer_id, "wish_balance": {"$gte": price}},
+                {"$inc": {"wish_balance": -price}},
+                session=session
+            ):
+                raise AbortTransaction("Insufficient wishes")
+            undo.append(lambda: users.update_one({"user_id": buyer_id}, {"$inc": {"wish_balance": price}}))
+            
+            if not move_card(seller_id, buyer_id, listing["card_id"], session):
+                raise AbortTransaction("Seller no longer owns this card")
+            
+            users.update_one({"user_id": seller_id}, {"$inc": {"wish_balance": price}}, session=session)
+            ledger.write_now([
+                build_transaction(buyer_id, "p2p_purchase", -price, f"Bought {listing['card_id']} from P2P"),
+                build_transaction(seller_id, "p2p_sale", price, f"Sold {listing['card_id']} on P2P"),
+            ], session=session)
+            return listing
+        except AbortTransaction:
+            if session is None:
+                for compensate in reversed(undo):
+                    compensate()
+            raise
+    
+    try:
+        listing = run_in_transaction(settle)
+        invalidate_user(buyer_id, listing["seller_id"])
+        return True, listing
+    except AbortTransaction as e:
+        invalidate_user(buyer_id)
+        return False, str(e)
+
 def buy_from_p2p(buyer_id, listing_id):
     """Buy a card from P2P marketplace"""
-    listing = p2p_listings.find_one({"_id": listing_id, "is_active": True})
-    if not listing:
-        return False, "Listing not found"
-    
-    buyer = get_user(buyer_id)
-    if not buyer or buyer["wish_balance"] < listing["price"]:
-        return False, "Insufficient wishes"
-    
-    if buyer_id == listing["seller_id"]:
-        return False, "Cannot buy your own listing"
-    
-    # Get card details
-    seller_card = user_cards.find_one({
-        "user_id": listing["seller_id"],
-        "card_id": listing["card_id"]
-    })
-    if not seller_card:
-        return False, "Seller no longer owns this card"
-    
-    # Transfer wishes
-    users.update_one({"user_id": buyer_id}, {"$inc": {"wish_balance": -listing["price"]}})
-    users.update_one({"user_id": listing["seller_id"]}, {"$inc": {"wish_balance": listing["price"]}})
-    
-    # Transfer card ownership
-    transfer_card(listing["seller_id"], buyer_id, listing["card_id"])
-    
-    # Deactivate listing
-    p2p_listings.update_one({"_id": listing_id}, {"$set": {"is_active": False}})
-    
-    # Record transactions
-    record_transaction(buyer_id, "p2p_purchase", -listing["price"], f"Bought {listing['card_id']} from P2P")
-    record_transaction(listing["seller_id"], "p2p_sale", listing["price"], f"Sold {listing['card_id']} on P2P")
-    
-    return True, listing
+    return execute_p2p_purchase(buyer_id, listing_id, transfer_card)
 
 def remove_p2p_listing(user_id, listing_id):
     """Remove a P2P listing"""
@@ -540,41 +706,68 @@ def update_p2p_listing_price(user_id, listing_id, new_price):
     return result.modified_count > 0
 
 # Card ownership management functions
-def add_card_to_user(user_id, card_id, card_name=None, rarity=None):
-    """Add a card to user's collection"""
-    card_data = {
-        "user_id": user_id,
-        "card_id": card_id,
-        "card_name": card_name,
-        "rarity": rarity,
-        "obtained_at": datetime.utcnow()
-    }
-    user_cards.insert_one(card_data)
+# Ownership is one owned_cards document per (user_id, card_id) with a `count` of copies.
+# Card names and rarities are resolved from the catalog, not stored per copy.
+def add_card_to_user(user_id, card_id, session=None):
+    """Add a copy of a card to user's collection"""
+    owned_cards.update_one(
+        {"user_id": user_id, "card_id": card_id},
+        {"$inc": {"count": 1}, "$setOnInsert": {"obtained_at": datetime.utcnow()}},
+        upsert=True,
+        session=session
+    )
+
+def remove_card_from_user(user_id, card_id, session=None):
+    """Remove one copy of a card from user's collection, returns False if they don't own it"""
+    card = owned_cards.find_one_and_update(
+        {"user_id": user_id, "card_id": card_id, "count": {"$gte": 1}},
+        {"$inc": {"count": -1}},
+        session=session,
+        return_document=ReturnDocument.AFTER
+    )
+    if not card:
+        return False
+    if card["count"] == 0:
+        owned_cards.delete_one({"_id": card["_id"], "count": 0}, session=session)
+    return True
 
 def user_owns_card(user_id, card_id):
     """Check if user owns a specific card"""
-    return user_cards.find_one({"user_id": user_id, "card_id": card_id}) is not None
-
-def transfer_card(from_user_id, to_user_id, card_id):
-    """Transfer a card from one user to another"""
-    # Remove from seller
-    card = user_cards.find_one({"user_id": from_user_id, "card_id": card_id})
-    if not card:
+    return owned_cards.find_one(
+        {"user_id": user_id, "card_id": card_id, "count": {"$gte": 1}},
+        {"_id": 1}
+    ) is not None
+
+def transfer_card(from_user_id, to_user_id, card_id, session=None):
+    """Transfer one copy of a card from one user to another"""
+    if not remove_card_from_user(from_user_id, card_id, session=session):
         return False
-    
-    user_cards.delete_one({"user_id": from_user_id, "card_id": card_id})
-    
-    # Add to buyer
-    add_card_to_user(to_user_id, card_id, card.get("card_name"), card.get("rarity"))
+    add_card_to_user(to_user_id, card_id, session=session)
     return True
 
 def get_user_cards(user_id):
-    """Get all cards owned by a user"""
-    return list(user_cards.find({"user_id": user_id}))
+    """Get all cards owned by a user (one document per card with its count)"""
+    return list(owned_cards.find({"user_id": user_id, "count": {"$gte": 1}}))
+
+def get_user_card_summary(user_id):
+    """Get a user's collection with counts and catalog details: [{card_id, name, rarity, count}]"""
+    if owned_cards is None:
+        return []
+    summary = []
+    for doc in owned_cards.find({"user_id": user_id, "count": {"$gte": 1}}, {"card_id": 1, "count": 1}).sort("card_id", 1):
+        card = card_catalog.get(doc["card_id"]) or {}
+        summary.append({
+            "card_id": doc["card_id"],
+            "name": card.get("name", doc["card_id"]),
+            "rarity": card.get("rarity", "Unknown"),
+            "count": doc["count"]
+        })
+    return summary
 
 def get_user_card_count(user_id, card_id):
     """Get the count of a specific card owned by user"""
-    return user_cards.count_documents({"user_id": user_id, "card_id": card_id})
+    card = owned_cards.find_one({"user_id": user_id, "card_id": card_id}, {"count": 1})
+    return card["count"] if card else 0
 
 # Rarity styling functions
 def get_rarity_emoji(rarity):
@@ -607,26 +800,85 @@ def get_rarity_color_text(rarity):
     }
     return rarity_styles.get(rarity, "⭐ <b>SPECIAL CARD</b> ⭐")
 
-def increment_message_count():
-    """Increment global message count to track bot activity"""
+# Message count is buffered in-process and written to Mongo with a single $inc
+MESSAGE_COUNT_FLUSH_INTERVAL = float(os.getenv('MESSAGE_COUNT_FLUSH_INTERVAL', 10))  # seconds
+MESSAGE_COUNT_FLUSH_EVERY = int(os.getenv('MESSAGE_COUNT_FLUSH_EVERY', 100))  # updates
+
+_message_count_lock = threading.Lock()
+_pending_message_count = 0
+_last_message_count_flush = time.monotonic()
+
+def increment_message_count(auto_flush=True):
+    """Increment global message count (buffered); with auto_flush=False returns True when a flush is due"""
+    global _pending_message_count
+    with _message_count_lock:
+        _pending_message_count += 1
+        should_flush = (
+            _pending_message_count >= MESSAGE_COUNT_FLUSH_EVERY
+            or time.monotonic() - _last_message_count_flush >= MESSAGE_COUNT_FLUSH_INTERVAL
+        )
+    if should_flush and auto_flush:
+        flush_message_count()
+        return False
+    return should_flush
+
+def flush_message_count():
+    """Write the buffered message count to Mongo with one $inc"""
+    global _pending_message_count, _last_message_count_flush
     if db is None:
-        print("Database not connected - cannot track message count")
-        return 0
+        return
     
-    stats_collection = db.bot_stats
-    result = stats_collection.find_one_and_update(
-        {"_id": "global_stats"},
-        {"$inc": {"message_count": 1}, "$set": {"last_message_time": datetime.utcnow()}},
-        upsert=True,
-        return_document=True
-    )
-    return result.get("message_count", 0) if result else 0
+    with _message_count_lock:
+        delta = _pending_message_count
+        _pending_message_count = 0
+        _last_message_count_flush = time.monotonic()
+    if not delta:
+        return
+    
+    try:
+        db.bot_stats.update_one(
+            {"_id": "global_stats"},
+            {"$inc": {"message_count": delta}, "$set": {"last_message_time": datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        # Keep the count so the next flush retries it
+        with _message_count_lock:
+            _pending_message_count += delta
+        print(f"Error flushing message count: {e}")
 
 def get_message_count():
-    """Get total message count"""
+    """Get total message count, including updates not yet flushed to Mongo"""
+    with _message_count_lock:
+        pending = _pending_message_count
     if db is None:
-        return 0
+        return pending
     
     stats_collection = db.bot_stats
     stats = stats_collection.find_one({"_id": "global_stats"})
-    return stats.get("message_count", 0) if stats else 0
\ No newline at end of file
+    return (stats.get("message_count", 0) if stats else 0) + pending
+
+# Leases - a Mongo document per name that only one owner can hold until it expires.
+# Used so scheduled jobs run on a single instance when the bot is scaled out.
+def acquire_lease(name, owner, ttl):
+    """Take or renew the named lease for ttl seconds, returns True if owner now holds it"""
+    if db is None:
+        return True  # Demo mode - single process
+    now = datetime.utcnow()
+    try:
+        db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The upsert collided with a live lease held by someone else
+        return False
+    return True
+
+def get_active_user_ids(days=7):
+    """Get users with any transaction in the last `days` days"""
+    if transactions is None:
+        return []
+    since = datetime.utcnow() - timedelta(days=days)
+    return transactions.distinct("user_id", {"timestamp": {"$gte": since}})